@@ -0,0 +1,381 @@
+'''
+Benchmarks every API route on a seeded database, through the Flask test
+client and through a real WSGI server (werkzeug's threaded server in its
+own process), and compares the results with a stored baseline.
+
+Run from the backend directory:
+
+    python benchmarks/bench_api.py [--sizes 1000 100000 1000000]
+        [--categories 6] [--requests 200] [--concurrency 8]
+        [--modes client server] [--database-url URL]
+        [--save-baseline FILE] [--baseline FILE]
+
+For every size the questions are seeded into a new SQLite database, or
+into the PostgreSQL database at --database-url, whose tables are dropped
+and recreated (so only point it at a throwaway database).
+
+For each route the report shows requests per second, p50/p95/p99 latency,
+the mean number of SQL statements per request (from the Server-Timing
+header) and memory: the peak Python allocations of a request in client
+mode, the peak RSS of the server process in server mode.
+
+Before the load runs, a fixed set of read requests is sent once and the
+digests of their JSON bodies are recorded, so a baseline also pins the
+responses. With --baseline, these are reported as regressions and make
+the script exit with status 1:
+- changed responses
+- throughput lower than the baseline by more than --tolerance
+- p95 latency higher by more than --tolerance and 2 ms (the p99 of a few
+  hundred requests is too noisy to compare)
+- half a SQL statement per request or more above the baseline
+'''
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from flask import Flask  # noqa: E402
+
+from bench_async import percentile, start_server  # noqa: E402
+from seed import WORDS, seeded_database  # noqa: E402
+
+SERVER_PORT = 18090
+MEMORY_SAMPLE_REQUESTS = 20
+STATEMENT_SLACK = 0.5
+LATENCY_SLACK_MS = 2
+STATEMENTS_PATTERN = re.compile(r'desc="(\d+) statements"')
+
+PROBES = [
+    ('GET', '/categories', None),
+    ('GET', '/questions', None),
+    ('GET', '/questions?page=2&limit=20', None),
+    ('GET', '/questions?after_id=100&limit=5', None),
+    ('GET', '/categories/1/questions', None),
+    ('GET', '/categories/2/questions?page=3', None),
+    ('POST', '/questions/search', {'searchTerm': 'river'}),
+    ('POST', '/questions/search', {'searchTerm': 'plan'}),
+    ('GET', '/questions/suggest?q=bench&limit=5', None),
+]
+
+
+class TestClient:
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.headers, response.data
+
+
+class HTTPClient:
+    '''
+    One keep-alive connection per thread to the server on port.
+    '''
+
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(
+                '127.0.0.1', self.port)
+            connection.connect()
+            connection.sock.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        connection.request(method, path, data, headers)
+        response = connection.getresponse()
+        return response.status, response.headers, response.read()
+
+
+def make_scenarios(size, categories, count, seed=0):
+    '''
+    Returns a list of (route, requests), where requests is a list of
+    count (method, path, json body) tuples. The paths of the DELETE
+    requests are filled in with the ids created by the POST requests.
+    '''
+    rng = random.Random(seed)
+    pages = max(min(size // 10, 100), 1)
+    category_pages = max(min(size // categories // 10, 100), 1)
+
+    def quiz():
+        return {'previous_questions': rng.sample(range(1, size + 1),
+                                                 min(size, 5)),
+                'quiz_category': {'id': rng.randint(0, categories)}}
+
+    return [
+        ('GET /categories', [('GET', '/categories', None)] * count),
+        ('GET /questions', [
+            ('GET', '/questions?page=%d' % rng.randint(1, pages), None)
+            for _ in range(count)]),
+        ('GET /categories/<id>/questions', [
+            ('GET', '/categories/%d/questions?page=%d' % (
+                rng.randint(1, categories), rng.randint(1, category_pages)),
+             None)
+            for _ in range(count)]),
+        ('POST /questions/search', [
+            ('POST', '/questions/search', {'searchTerm': rng.choice(WORDS)})
+            for _ in range(count)]),
+        ('POST /quizzes', [('POST', '/quizzes', quiz())
+                           for _ in range(count)]),
+        ('POST /questions', [
+            ('POST', '/questions', {
+                'question': 'Created benchmark question %d?' % i,
+                'answer': 'Answer %d' % i,
+                'difficulty': i % 5 + 1,
+                'category': i % categories + 1})
+            for i in range(count)]),
+        ('DELETE /questions/<id>', [('DELETE', None, None)] * count),
+    ]
+
+
+def probe(client):
+    digests = {}
+    for method, path, body in PROBES:
+        status, headers, data = client.request(method, path, body)
+        canonical = json.dumps(json.loads(data), sort_keys=True)
+        key = '%s %s %s' % (method, path, json.dumps(body) if body else '')
+        digests[key.strip()] = '%d %s' % (
+            status, hashlib.sha256(canonical.encode('utf-8')).hexdigest())
+    return digests
+
+
+def run_scenario(client, requests, concurrency, created_ids):
+    '''
+    Sends requests from concurrency threads and returns the latencies,
+    the SQL statement counts and the number of 5xx responses.
+    '''
+    latencies = []
+    statements = []
+    errors = []
+    queue = list(reversed(requests))
+
+    def send(method, path, body):
+        if path is None:
+            path = '/questions/%d' % created_ids.pop()
+        started = time.perf_counter()
+        status, headers, data = client.request(method, path, body)
+        latencies.append(time.perf_counter() - started)
+        match = STATEMENTS_PATTERN.search(headers.get('Server-Timing', ''))
+        if match:
+            statements.append(int(match.group(1)))
+        if status >= 500:
+            errors.append(status)
+        elif method == 'POST' and path == '/questions':
+            created_ids.append(json.loads(data)['created_id'])
+
+    def work():
+        while True:
+            try:
+                request = queue.pop()
+            except IndexError:
+                return
+            send(*request)
+
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statements, errors
+
+
+def peak_request_memory(client, requests):
+    '''
+    Returns the largest peak of Python allocations (in KiB) of a sample of
+    requests, or None for deletes, which can't be repeated. Created
+    questions are deleted again, so the sample does not change what the
+    timed run deletes.
+    '''
+    peak = None
+    for method, path, body in requests[:MEMORY_SAMPLE_REQUESTS]:
+        if path is None:
+            continue
+        tracemalloc.start()
+        status, headers, data = client.request(method, path, body)
+        peak = max(peak or 0, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        if method == 'POST' and path == '/questions':
+            client.request('DELETE', '/questions/%d' %
+                           json.loads(data)['created_id'])
+    return None if peak is None else round(peak / 1024, 1)
+
+
+def server_peak_rss(process):
+    try:
+        with open('/proc/%d/status' % process.pid) as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def summarize(requests, elapsed, latencies, statements, errors):
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'statements': round(sum(statements) / len(statements), 2)
+        if statements else None,
+        'errors': len(errors),
+    }
+
+
+def benchmark(size, args):
+    from flaskr import create_app
+
+    database_url = seeded_database(
+        Flask(__name__), size, args.categories, args.database_url)
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_url,
+                      'SERVER_TIMING': True, 'RATE_LIMITING': False})
+    client = TestClient(app)
+    report = {'responses': probe(client), 'results': {}}
+    scenarios = make_scenarios(size, args.categories, args.requests)
+
+    for mode in args.modes:
+        results = report['results'][mode] = {}
+        process = None
+        concurrency = 1
+        if mode == 'server':
+            process = start_server('wsgi', SERVER_PORT, database_url,
+                                   SERVER_TIMING='true')
+            client = HTTPClient(SERVER_PORT)
+            concurrency = args.concurrency
+        created_ids = []
+        try:
+            for route, requests in scenarios:
+                started = time.perf_counter()
+                latencies, statements, errors = run_scenario(
+                    client, requests, concurrency, created_ids)
+                result = summarize(requests, time.perf_counter() - started,
+                                   latencies, statements, errors)
+                if mode == 'client':
+                    result['peak_request_kib'] = peak_request_memory(
+                        client, requests)
+                else:
+                    result['server_rss_mib'] = server_peak_rss(process)
+                results[route] = result
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+    return report
+
+
+def print_report(size, report):
+    print('\n%d questions' % size)
+    print('%-7s %-32s %8s %8s %8s %8s %6s %9s %6s' % (
+        'mode', 'route', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'stmts',
+        'memory', 'errors'))
+    for mode, results in report['results'].items():
+        for route, result in results.items():
+            memory = '-'
+            if result.get('peak_request_kib') is not None:
+                memory = '%.0f KiB' % result['peak_request_kib']
+            elif result.get('server_rss_mib') is not None:
+                memory = '%.0f MiB' % result['server_rss_mib']
+            print('%-7s %-32s %8.0f %8.2f %8.2f %8.2f %6s %9s %6d' % (
+                mode, route, result['rps'], result['p50_ms'],
+                result['p95_ms'], result['p99_ms'], result['statements'],
+                memory, result['errors']))
+
+
+def compare(size, report, baseline, tolerance):
+    '''
+    Returns the regressions of report against the baseline of the same
+    size.
+    '''
+    regressions = []
+    for key, digest in baseline['responses'].items():
+        if report['responses'].get(key) != digest:
+            regressions.append('%d: response of %s changed' % (size, key))
+
+    for mode, results in baseline['results'].items():
+        for route, expected in results.items():
+            result = report['results'].get(mode, {}).get(route)
+            if result is None:
+                continue
+            name = '%d %s %s' % (size, mode, route)
+            if result['rps'] < expected['rps'] * (1 - tolerance):
+                regressions.append('%s: %.0f req/s, baseline %.0f' % (
+                    name, result['rps'], expected['rps']))
+            if result['p95_ms'] > max(expected['p95_ms'] * (1 + tolerance),
+                                      expected['p95_ms'] + LATENCY_SLACK_MS):
+                regressions.append('%s: p95 %.2f ms, baseline %.2f' % (
+                    name, result['p95_ms'], expected['p95_ms']))
+            if (result['statements'] or 0) >= \
+                    (expected['statements'] or 0) + STATEMENT_SLACK:
+                regressions.append('%s: %s statements, baseline %s' % (
+                    name, result['statements'], expected['statements']))
+            if result['errors'] > expected['errors']:
+                regressions.append('%s: %d errors, baseline %d' % (
+                    name, result['errors'], expected['errors']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000])
+    parser.add_argument('--categories', type=int, default=6)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='client threads in server mode')
+    parser.add_argument('--modes', nargs='+', default=['client', 'server'],
+                        choices=['client', 'server'])
+    parser.add_argument('--database-url')
+    parser.add_argument('--save-baseline')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5)
+    args = parser.parse_args()
+
+    reports = {}
+    for size in args.sizes:
+        reports[str(size)] = benchmark(size, args)
+        print_report(size, reports[str(size)])
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(reports, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+        regressions = []
+        for size, report in reports.items():
+            if size in baselines:
+                regressions += compare(int(size), report, baselines[size],
+                                       args.tolerance)
+        print()
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+        print('No regressions against %s' % args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+'''
+Load test of the WSGI app (werkzeug's threaded server) against the asyncio
+serving mode (uvicorn running flaskr.asgi:create_asgi_app) on the same
+seeded database. Each server runs in its own process and is driven by
+--concurrency keep-alive connections for --duration seconds with a mix of
+question listings, category listings and quiz requests. Prints requests per
+second and p50/p99 latencies.
+
+Run from the backend directory:
+
+    python benchmarks/bench_async.py [--size 10000] [--concurrency 64]
+
+The questions are seeded into a throwaway SQLite database unless
+--database-url points to a prepared PostgreSQL database.
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from seed import seeded_database  # noqa: E402
+
+
+def serve_wsgi(port):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from flaskr import create_app
+
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body are written separately, which Nagle's algorithm
+        # would delay by a round trip on keep-alive connections.
+        disable_nagle_algorithm = True
+
+        def log_request(self, *args):
+            pass
+
+    make_server('127.0.0.1', port, create_app(), threaded=True,
+                request_handler=KeepAliveHandler).serve_forever()
+
+
+def start_server(mode, port, database_url, **environ):
+    # All the load comes from one client address, which the per-client rate
+    # limits would throttle.
+    env = dict(os.environ, DATABASE_URL=database_url, RATE_LIMITING='false')
+    env.update(environ)
+    if mode == 'wsgi':
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--serve-wsgi', str(port)]
+    else:
+        command = [sys.executable, '-m', 'uvicorn', '--factory',
+                   'flaskr.asgi:create_asgi_app', '--port', str(port),
+                   '--log-level', 'warning', '--no-access-log']
+    process = subprocess.Popen(command, cwd=BACKEND, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('%s server did not start' % mode)
+
+
+def make_requests(size):
+    pages = max(size // 10, 1)
+    requests = []
+    for _ in range(100):
+        kind = random.random()
+        if kind < 0.4:
+            body = json.dumps({
+                'previous_questions': random.sample(range(1, size + 1), 5),
+                'quiz_category': {'id': random.randint(0, 6)}
+            }).encode('utf-8')
+            requests.append(
+                b'POST /quizzes HTTP/1.1\r\nHost: bench\r\n'
+                b'Content-Type: application/json\r\n'
+                b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+        elif kind < 0.7:
+            requests.append(
+                b'GET /questions?page=%d HTTP/1.1\r\nHost: bench\r\n\r\n'
+                % random.randint(1, min(pages, 50)))
+        else:
+            requests.append(
+                b'GET /categories/%d/questions HTTP/1.1\r\nHost: bench\r\n\r\n'
+                % random.randint(1, 6))
+    return requests
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    length = 0
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def worker(port, requests, deadline, latencies, errors):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while time.monotonic() < deadline:
+            request = random.choice(requests)
+            started = time.perf_counter()
+            writer.write(request)
+            status = await read_response(reader)
+            latencies.append(time.perf_counter() - started)
+            if status >= 500:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def load(port, requests, concurrency, duration):
+    latencies = []
+    errors = []
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*[
+        worker(port, requests, deadline, latencies, errors)
+        for _ in range(concurrency)])
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--database-url')
+    parser.add_argument('--serve-wsgi', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_wsgi:
+        serve_wsgi(args.serve_wsgi)
+        return
+
+    database_url = args.database_url
+    if database_url is None:
+        from flask import Flask
+        database_url = seeded_database(Flask(__name__), args.size)
+
+    requests = make_requests(args.size)
+    print('%-6s %10s %10s %10s %8s' % (
+        'mode', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for port, mode in enumerate(('wsgi', 'asgi'), start=18080):
+        process = start_server(mode, port, database_url)
+        try:
+            # Warm up the caches and pools before measuring.
+            asyncio.run(load(port, requests, 4, 1))
+            latencies, errors = asyncio.run(
+                load(port, requests, args.concurrency, args.duration))
+        finally:
+            process.terminate()
+            process.wait()
+        print('%-6s %10.0f %10.1f %10.1f %8d' % (
+            mode, len(latencies) / args.duration,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000, len(errors)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+'''
+Compares the cost of loading question rows as ORM Question instances (and
+formatting them, as the read endpoints used to) with the column tuples of
+select_questions and with the Core rows of fetch_rows. Prints the CPU time
+and the memory held by the result and allocated at peak while loading,
+both per 10k rows.
+
+Run from the backend directory:
+
+    python benchmarks/bench_read_models.py [--size 10000]
+
+The questions are seeded into a throwaway SQLite database, so the numbers
+include the driver's work but no network round trips.
+'''
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+
+from models import db, Question  # noqa: E402
+from flaskr.serializers import fetch_rows, select_questions  # noqa: E402
+from seed import seeded_database  # noqa: E402
+
+
+def orm_instances(size):
+    questions = Question.query.order_by(Question.id).limit(size).all()
+    return questions, [question.format() for question in questions]
+
+
+def query_tuples(size):
+    return select_questions(Question.query).order_by(
+        Question.id).limit(size).all()
+
+
+def core_rows(size):
+    return fetch_rows(select_questions(Question.query).order_by(
+        Question.id).limit(size))
+
+
+def measure_time(function, size, repeat):
+    best = None
+    for _ in range(repeat):
+        db.session.remove()
+        start = time.process_time()
+        function(size)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    db.session.remove()
+    return best
+
+
+def measure_memory(function, size):
+    '''
+    Returns the bytes still allocated while the result is held (including
+    the session's identity map) and the peak allocated while loading.
+    '''
+    db.session.remove()
+    tracemalloc.start()
+    result = function(size)
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    db.session.remove()
+    return held, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    seeded_database(app, args.size)
+    scale = 10000 / args.size
+
+    with app.app_context():
+        print('%-28s %10s %10s %10s' % (
+            'per 10k rows', 'cpu ms', 'held KiB', 'peak KiB'))
+        baseline = None
+        for name, function in [
+                ('ORM instances + format()', orm_instances),
+                ('query column tuples', query_tuples),
+                ('Core rows (fetch_rows)', core_rows)]:
+            elapsed = measure_time(function, args.size, args.repeat)
+            held, peak = measure_memory(function, args.size)
+            baseline = baseline or elapsed
+            print('%-28s %10.1f %10.0f %10.0f  x%.1f' % (
+                name, elapsed * 1000 * scale, held / 1024 * scale,
+                peak / 1024 * scale, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
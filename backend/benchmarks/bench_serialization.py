@@ -0,0 +1,89 @@
+'''
+Compares the serialization of question listings through Question.format()
+and jsonify with the tuple rows and json_response of flaskr.serializers,
+and with streaming the rows through stream_questions.
+
+Run from the backend directory:
+
+    python benchmarks/bench_serialization.py [--sizes 10 1000 100000]
+
+The questions are seeded into a throwaway SQLite database, so the numbers
+include loading the rows but no network round trips.
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, jsonify  # noqa: E402
+
+from models import db, Question  # noqa: E402
+from flaskr.serializers import (  # noqa: E402
+    json_response, select_questions, stream_questions, QuestionRows)
+from seed import seeded_database  # noqa: E402
+
+
+def format_and_jsonify(size):
+    questions = Question.query.order_by(Question.id).limit(size).all()
+    return jsonify({
+        'success': True,
+        'questions': [question.format() for question in questions],
+        'total_questions': size
+    }).get_data()
+
+
+def rows_and_json_response(size):
+    rows = select_questions(Question.query).order_by(
+        Question.id).limit(size).all()
+    return json_response({
+        'success': True,
+        'questions': QuestionRows(rows),
+        'total_questions': size
+    }).get_data()
+
+
+def streamed(size):
+    rows = select_questions(Question.query).order_by(
+        Question.id).limit(size)
+    return ''.join(stream_questions({'success': True}, rows))
+
+
+def measure(function, size, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = function(size)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    db.session.remove()
+    return best, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 1000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    seeded_database(app, max(args.sizes))
+
+    with app.app_context():
+        print('%8s  %-24s %12s %12s' % ('rows', 'path', 'best ms', 'bytes'))
+        for size in args.sizes:
+            baseline = None
+            for name, function in [
+                    ('format() + jsonify', format_and_jsonify),
+                    ('rows + json_response', rows_and_json_response),
+                    ('rows + stream', streamed)]:
+                elapsed, length = measure(function, size, args.repeat)
+                baseline = baseline or elapsed
+                print('%8d  %-24s %12.2f %12d  x%.1f' % (
+                    size, name, elapsed * 1000, length, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+'''
+Seeds a database with generated categories and questions for the
+benchmarks. The data only depends on the arguments, so two runs with the
+same sizes see the same rows.
+'''
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import (setup_db, db, Question, Category,  # noqa: E402
+                    rebuild_question_counts)
+
+SEED_BATCH_SIZE = 10000
+
+WORDS = ['river', 'planet', 'painter', 'goal', 'novel', 'element', 'empire',
+         'ocean', 'composer', 'mountain', 'vaccine', 'island', 'poem',
+         'engine', 'desert', 'treaty']
+
+
+def seed(size, categories=6):
+    db.session.execute(Category.__table__.insert(), [
+        {'type': 'Category %d' % i} for i in range(1, categories + 1)])
+    for start in range(0, size, SEED_BATCH_SIZE):
+        db.session.execute(Question.__table__.insert(), [{
+            'question': 'Benchmark question number %d, about a %s and a %s?'
+                        % (i, WORDS[i % len(WORDS)],
+                           WORDS[i // len(WORDS) % len(WORDS)]),
+            'answer': 'Answer %d' % i,
+            'difficulty': i % 5 + 1,
+            'category': i % categories + 1
+        } for i in range(start, min(start + SEED_BATCH_SIZE, size))])
+    db.session.commit()
+    rebuild_question_counts()
+
+
+def seeded_database(app, size, categories=6, database_url=None):
+    '''
+    Binds app to database_url, or to a new SQLite file if it is None,
+    creates the tables and seeds them. Returns the database url.
+    '''
+    if database_url is None:
+        database_url = 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'bench.db')
+    setup_db(app, database_url)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed(size, categories)
+    return database_url
@@ -1,29 +1,174 @@
 import os
-from flask import Flask, request, abort, jsonify
+import threading
+import time
+from urllib.parse import urlencode
+
+from flask import (Flask, Response, request, abort, g, jsonify,
+                   stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
-
-from models import setup_db, Question, Category
 
-QUESTIONS_PER_PAGE = 10
+from models import (setup_db, db, Question, Category,
+                    rebuild_question_counts)
+from .bulk import export_questions, import_questions
+from .cache import ResponseCache, backend_from_url
+from .categories import category_cache
+from .compaction import Compactor
+from .http_cache import conditional_get
+from .limits import RATE_LIMITS, create_limiters, retry_after_header
+from .metrics import PROMETHEUS_CONTENT_TYPE, metrics
+from .pagination import paginate_ids, paginate_questions, total_questions
+from .quiz import (ALL_CATEGORIES, MAX_DIFFICULTY, MIN_DIFFICULTY,
+                   QUIZ_BATCH_MAX, QUIZ_BATCH_SIZE, quiz_index,
+                   target_difficulty)
+from .search import search_backend, tokenize
+from .serializers import (EncodedJSON, fetch_rows, json_response,
+                          select_questions)
+from .sessions import (QUIZ_SESSION_MAX_QUESTIONS, QUIZ_SESSION_QUESTIONS,
+                       QuizSessions)
+from .startup import WARM_UP_MODES, start_warm_up
+from .stats import question_stats
+from .suggest import suggest_index
+
+MAX_SUGGESTIONS = 10
+
+# POST endpoints that only read, and may do so from a read replica.
+READ_ONLY_ENDPOINTS = frozenset([
+    'search_for_question',
+    'get_questions_to_play_quiz',
+    'get_batch_of_questions_to_play_quiz',
+    'get_adaptive_quiz_question',
+    'start_quiz_session',
+    'next_quiz_session_question',
+])
 
 
 def create_app(test_config=None):
+    started = time.perf_counter()
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    # The database defaults to DATABASE_URL unless the config names one.
+    if app.config.get('SQLALCHEMY_DATABASE_URI'):
+        setup_db(app, app.config['SQLALCHEMY_DATABASE_URI'])
+    else:
+        setup_db(app)
+
+    @app.cli.command('init-db')
+    def init_db():
+        '''Create the database tables and indexes that don't exist yet.'''
+        db.create_all()
+        rebuild_question_counts()
+
+    @app.cli.command('rebuild-stats')
+    def rebuild_stats():
+        '''Recount the question_counts table from the questions.'''
+        rebuild_question_counts()
+
+    # Deleted questions are tombstones until the compactor purges them.
+    compactor = Compactor.from_settings(app)
+    app.extensions['compactor'] = compactor
+
+    @app.cli.command('compact-questions')
+    def compact_questions():
+        '''Purge deleted questions older than DB_TOMBSTONE_RETENTION.'''
+        print('Purged %d deleted questions.' % compactor.run_once())
 
     '''
     Set up CORS. Allow '*' for origins.
     '''
     cors = CORS(app, resources={r"/*": {"origins": "*"}})
 
+    quiz_sessions = QuizSessions(quiz_index)
+
+    # Responses are cached in process, or in Redis when RESPONSE_CACHE_URL
+    # is set, so that all workers share the cache.
+    response_cache = ResponseCache(
+        app.config.get('RESPONSE_CACHE_BACKEND') or
+        backend_from_url(os.environ.get('RESPONSE_CACHE_URL')))
+    app.extensions['response_cache'] = response_cache
+
+    # The caches most requests need (categories, quiz index and the
+    # search-as-you-type index) are loaded when create_app returns, in the
+    # background or on first use, see flaskr/startup.py.
+    warm_up_mode = str(app.config.get(
+        'WARM_UP', os.environ.get('WARM_UP', 'sync'))).lower()
+    if warm_up_mode not in WARM_UP_MODES:
+        raise ValueError('WARM_UP must be one of ' + ', '.join(WARM_UP_MODES))
+
     # @app.route('/messages')
     # @cross_origin()
     # def get_messages():
     # return 'GETTING MESSAGES'
 
+    # Server-Timing headers are opt-in, since they tell clients how long
+    # the database took.
+    app.config['SERVER_TIMING'] = str(app.config.get(
+        'SERVER_TIMING', os.environ.get('SERVER_TIMING', ''))).lower() in (
+        '1', 'true', 'yes', 'on')
+
+    first_request_served = threading.Event()
+
+    @app.before_request
+    def start_request_metrics():
+        metrics.start_request()
+
+    @app.after_request
+    def record_first_request(response):
+        if not first_request_served.is_set():
+            first_request_served.set()
+            metrics.record_startup(
+                'first_request', time.perf_counter() - started)
+        return response
+
+    # Requests that write send their reads to the primary too, so they
+    # don't act on rows a replica hasn't caught up with yet. GET handlers
+    # and quizzes read from the replicas, if there are any.
+    @app.before_request
+    def route_writes_to_primary():
+        if (request.method not in ('GET', 'HEAD', 'OPTIONS') and
+                request.endpoint not in READ_ONLY_ENDPOINTS):
+            db.session().use_primary()
+
+    @app.after_request
+    def record_request_metrics(response):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_metrics, duration = metrics.finish_request(
+            request.method, route, response.status_code)
+        if request_metrics is not None and app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = \
+                request_metrics.server_timing(duration)
+        return response
+
+    # The expensive endpoints of RATE_LIMITS are limited per client with
+    # token buckets (429 once a client's bucket is empty), and only a few of
+    # their requests are served at once, so a burst of them can't take every
+    # database connection; requests that can't get a slot in time get 503.
+    rate_limiter, concurrency_limiter = create_limiters(app)
+    limited_endpoints = app.config.get('RATE_LIMITS', RATE_LIMITS)
+    app.extensions['rate_limiter'] = rate_limiter
+    app.extensions['concurrency_limiter'] = concurrency_limiter
+    app.extensions['limited_endpoints'] = limited_endpoints
+
+    @app.before_request
+    def admit_request():
+        if request.endpoint not in limited_endpoints:
+            return
+        if rate_limiter is not None:
+            retry_after = rate_limiter.check(
+                request.remote_addr, request.endpoint)
+            if retry_after:
+                abort(429, retry_after=retry_after_header(retry_after))
+        if not concurrency_limiter.acquire():
+            abort(503, retry_after=1)
+        g.admitted = True
+
+    @app.teardown_request
+    def release_admission(error):
+        if g.pop('admitted', False):
+            concurrency_limiter.release()
+
     '''
     Use the after_request decorator to set Access-Control-Allow
     '''
@@ -40,26 +185,29 @@ def create_app(test_config=None):
 
     '''
   Endpoint that handles GET requests for all available categories.
+  Like the question listings below, it sends an ETag built from the data
+  versions the response depends on and answers a matching If-None-Match
+  with 304 without touching the database.
   '''
     @app.route('/categories')
+    @conditional_get(lambda: ['categories'])
     def get_categories():
-        categories = Category.query.order_by(Category.id).all()
-        categories_dict = {}
-        for category in categories:
-            categories_dict[category.id] = category.type
+        return app.response_class(category_cache.json(),
+                                  mimetype='application/json')
 
-        return jsonify({
-            'success': True,
-            'categories': categories_dict
-        })
+    def includes_questions(request):
+        include = request.args.get('include', '')
+        return 'questions' in include.split(',')
+
+    def args_key(**view_args):
+        return urlencode(sorted(request.args.items(multi=True)))
 
-    def paginate_questions(request, questions):
-        page = request.args.get('page', 1, type=int)
-        start = (page - 1) * QUESTIONS_PER_PAGE
-        end = start + QUESTIONS_PER_PAGE
-        questions = [question.format() for question in questions]
-        current_questions = questions[start:end]
-        return current_questions
+    def search_key():
+        body = request.get_json(silent=True) or {}
+        search_term = body.get('searchTerm') if isinstance(body, dict) else ''
+        if not isinstance(search_term, str):
+            search_term = repr(search_term)
+        return ' '.join(tokenize(search_term)) + '?' + args_key()
 
     '''
   Error handlers for all expected errors.
@@ -96,6 +244,17 @@ def create_app(test_config=None):
             'message': 'unprocessable entity'
         }), 422
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            'success': False,
+            'error': 429,
+            'message': 'too many requests'
+        })
+        if getattr(error, 'retry_after', None):
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response, 429
+
     @app.errorhandler(500)
     def internal_server_error(error):
         return jsonify({
@@ -106,11 +265,14 @@ def create_app(test_config=None):
 
     @app.errorhandler(503)
     def service_unavailable(error):
-        return jsonify({
+        response = jsonify({
             'success': False,
             'error': 503,
             'message': 'service unavailable'
-        }), 503
+        })
+        if getattr(error, 'retry_after', None):
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response, 503
 
     '''
   Endpoint that handles GET requests for questions, including pagination.
@@ -118,22 +280,21 @@ def create_app(test_config=None):
   and a dict of all categories.
   '''
     @app.route('/questions', methods=['GET'])
+    @conditional_get(lambda: ['generation', 'questions', 'categories'])
+    @response_cache.cached(lambda: 'questions', args_key)
     def get_questions():
-        questions = Question.query.order_by(Question.id).all()
-        current_questions = paginate_questions(request, questions)
+        page = paginate_questions(request)
 
-        if len(current_questions) == 0:
+        if len(page.questions) == 0:
             abort(404)
 
-        categories = Category.query.order_by(Category.id).all()
-        categories_dict = {}
-        for category in categories:
-            categories_dict[category.id] = category.type
+        categories_dict = category_cache.get()
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'questions': current_questions,
-            'total_questions': len(questions),
+            'questions': page.questions,
+            'total_questions': page.total_questions,
+            'next_cursor': page.next_cursor,
             'current_category': '0',
             'categories': categories_dict
         })
@@ -144,39 +305,46 @@ def create_app(test_config=None):
     TEST: When you click the trash icon next to a question,
     the question will be removed. This removal will persist
     in the database and when you refresh the page.
+
+    The response only carries the deleted id and the new total, unless the
+    request asks for the current page with '?include=questions'.
     '''
     @app.route('/questions/<int:question_id>', methods=['DELETE'])
     def delete_question(question_id):
         try:
-            question = Question.query.filter(
+            question = Question.live().filter(
                 Question.id == question_id).one_or_none()
 
             if not question:
                 abort(422)
 
-            question.delete()
-            questions = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, questions)
-            categories = Category.query.order_by(Category.id).all()
-            categories_dict = {}
-            for category in categories:
-                categories_dict[category.id] = category.type
+            if not question.delete():
+                # Deleted by a concurrent request.
+                abort(422)
 
-            return jsonify({
+            response = {
                 'success': True,
                 'deleted_id': question_id,
-                'questions': current_questions,
-                'total_questions': len(questions),
-                'categories': categories_dict
-            })
+                'total_questions': total_questions()
+            }
+            if includes_questions(request):
+                page = paginate_questions(request)
+                response['questions'] = page.questions
+                response['total_questions'] = page.total_questions
+                response['categories'] = category_cache.get()
+
+            return json_response(response)
 
         except BaseException:
             abort(422)
 
     '''
   Endpoint to POST in order to search for a question based on a search term.
+  Questions match if their question or answer text contains a word starting
+  with each word of the search term. Results are ranked by relevance.
   '''
     @app.route('/questions/search', methods=['POST'])
+    @response_cache.cached(lambda: 'search', search_key)
     def search_for_question():
         body = request.get_json()
         if not body:
@@ -184,31 +352,89 @@ def create_app(test_config=None):
         search_term = body.get('searchTerm')
         if not search_term or not isinstance(search_term, str):
             abort(400)
-        questions = Question.query.filter(
-            Question.question.ilike(
-                '%' +
-                search_term +
-                '%')) .order_by(
-            Question.id).all()
-
-        current_questions = paginate_questions(request, questions)
+        question_ids = search_backend().search(search_term)
+        page = paginate_ids(
+            request, question_ids,
+            lambda ids: fetch_rows(select_questions(Question.live()).filter(
+                Question.id.in_(ids))))
 
-        categories = Category.query.order_by(Category.id).all()
-        categories_dict = {}
-        for category in categories:
-            categories_dict[category.id] = category.type
+        categories_dict = category_cache.get()
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'questions': current_questions,
-            'total_questions': len(questions),
+            'questions': page.questions,
+            'total_questions': page.total_questions,
+            'next_cursor': page.next_cursor,
             'current_category': '0',
             'categories': categories_dict
         })
 
+    '''
+  Endpoint for search-as-you-type. Returns the ids and the first characters of
+  the questions containing words starting with every word of q. Suggestions
+  come from an in-memory prefix index and never touch the database.
+  '''
+    @app.route('/questions/suggest', methods=['GET'])
+    def suggest_questions():
+        text = request.args.get('q', '')
+        limit = request.args.get('limit', MAX_SUGGESTIONS, type=int)
+        if not text.strip() or limit < 1:
+            abort(400)
+
+        suggestions = suggest_index.suggest(
+            text, min(limit, MAX_SUGGESTIONS))
+
+        return jsonify({
+            'success': True,
+            'suggestions': [{'id': question_id, 'question': snippet}
+                            for question_id, snippet in suggestions]
+        })
+
+    '''
+  Endpoint for question statistics: the total number of questions and their
+  distribution over difficulties, per category and overall. They come from
+  the question_counts table, which every question write keeps up to date,
+  so no questions are counted.
+  '''
+    @app.route('/stats', methods=['GET'])
+    @conditional_get(lambda: ['generation', 'questions', 'categories'])
+    @response_cache.cached(lambda: 'questions', lambda: 'stats')
+    def get_stats():
+        stats = question_stats(category_cache.get())
+        stats['success'] = True
+        return json_response(stats)
+
+    '''
+  Reports the hits, misses and evictions of the response cache.
+  '''
+    @app.route('/cache/stats', methods=['GET'])
+    def get_cache_stats():
+        return jsonify({
+            'success': True,
+            'stats': response_cache.stats()
+        })
+
+    '''
+  Reports request counts, latencies, SQL statements and rows, and JSON
+  encoding time per route in the Prometheus text format.
+  '''
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return app.response_class(metrics.render(),
+                                  content_type=PROMETHEUS_CONTENT_TYPE)
+
+    @app.route('/questions/suggest/stats', methods=['GET'])
+    def get_suggest_stats():
+        return jsonify({
+            'success': True,
+            'stats': suggest_index.stats()
+        })
+
     '''
   Endpoint to POST in order to post a new question, which requires
   the question and answer text, category and difficulty score.
+  The response only carries the created id and the new total, unless the
+  request asks for the current page with '?include=questions'.
   '''
     @app.route('/questions', methods=['POST'])
     def create_question():
@@ -224,30 +450,71 @@ def create_app(test_config=None):
 
         try:
             question = Question(question=question, answer=answer,
-                                difficulty=difficulty, category=category)
-
-            question.insert()
+                                difficulty=int(difficulty),
+                                category=int(category))
 
-            questions = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, questions)
+            created = question.insert()
 
-            categories = Category.query.order_by(Category.id).all()
-            categories_dict = {}
-            for category in categories:
-                categories_dict[category.id] = category.type
-
-            return jsonify({
+            response = {
                 'success': True,
-                'created_id': question.id,
-                'questions': current_questions,
-                'total_questions': len(questions),
-                'current_category': '0',
-                'categories': categories_dict
-            })
+                'created_id': created['id'],
+                'total_questions': total_questions(),
+                'current_category': '0'
+            }
+            if includes_questions(request):
+                page = paginate_questions(request)
+                response['questions'] = page.questions
+                response['total_questions'] = page.total_questions
+                response['categories'] = category_cache.get()
+
+            return json_response(response)
 
         except BaseException:
             abort(422)
 
+    '''
+  Endpoint to import many questions at once. The body is streamed as NDJSON
+  (one question object per line) or, with '?format=csv' or a text/csv
+  content type, as CSV with a question,answer,difficulty,category header.
+  Invalid rows are reported by line number and skipped.
+  '''
+    @app.route('/questions/bulk', methods=['POST'])
+    def import_question_bulk():
+        format = request.args.get('format')
+        if format is None and request.mimetype == 'text/csv':
+            format = 'csv'
+        if format not in (None, 'csv', 'ndjson'):
+            abort(400)
+
+        report = import_questions(request.stream, format)
+
+        return jsonify({
+            'success': True,
+            'inserted': report['inserted'],
+            'failed': report['failed'],
+            'errors': report['errors']
+        })
+
+    '''
+  Endpoint to export all questions, streamed as NDJSON or, with
+  '?format=csv' or '?format=json', as CSV or as one JSON object with a
+  questions list.
+  '''
+    @app.route('/questions/export', methods=['GET'])
+    def export_question_bulk():
+        format = request.args.get('format', 'ndjson')
+        mimetypes = {
+            'csv': 'text/csv',
+            'json': 'application/json',
+            'ndjson': 'application/x-ndjson'
+        }
+        if format not in mimetypes:
+            abort(400)
+
+        mimetype = mimetypes[format]
+        return Response(stream_with_context(export_questions(format)),
+                        mimetype=mimetype)
+
     '''
   Handles not allowed new question post request to specific question endpoint.
   '''
@@ -256,28 +523,33 @@ def create_app(test_config=None):
         abort(405)
 
     '''
-  GET endpoint to get questions based on category.
+  GET endpoint to get questions based on category. The category filter and
+  the ordering by id are both served by the questions_category_idx index.
   '''
     @app.route('/categories/<int:category_id>/questions')
+    @conditional_get(lambda category_id: [
+        'generation', 'category:' + str(category_id), 'categories'])
+    @response_cache.cached(
+        lambda category_id: 'category:' + str(category_id), args_key)
     def get_questions_of_category(category_id):
-        category_ids = Category.query.with_entities(Category.id).all()
-        category_ids = [category_id_num[0] for category_id_num in category_ids]
-        if category_id not in category_ids:
-            abort(404)
-        questions = Question.query.join(
-            Category, Question.category == category_id).order_by(
-            Question.category).all()
-        current_questions = paginate_questions(request, questions)
+        # Categories created by another process may not be cached yet,
+        # so fall back to a primary key lookup before giving up.
+        if not category_cache.exists(category_id):
+            if Category.query.get(category_id) is None:
+                abort(404)
+            category_cache.invalidate()
+
+        page = paginate_questions(request, category_id)
 
-        if len(current_questions) == 0 and request.args.get(
+        if len(page.questions) == 0 and request.args.get(
                 'page', 1, type=int) > 1:
             abort(404)
-        total_questions = len(questions)
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'questions': current_questions,
-            'total_questions': total_questions,
+            'questions': page.questions,
+            'total_questions': page.total_questions,
+            'next_cursor': page.next_cursor,
             'current_category': category_id
         })
 
@@ -307,39 +579,171 @@ def create_app(test_config=None):
                 not isinstance(quiz_category, dict)):
             abort(400)
 
-        category_id = quiz_category['id']
-
-        # If the category id is zero, no specific category is chosen and so we
-        # get all question ids from all categories.
-        # Otherwise, get the question ids from the specific category.
-        if category_id == 0:
-            question_ids = Question.query.with_entities(Question.id).all()
-        else:
-            question_ids = Question.query.filter(
-                Question.category == category_id). with_entities(
-                Question.id).all()
-
-        # We grab a random question id. If it is already a previous question,
-        # we pop it out of the question_ids array and try to find a new
-        # question id.
-        question_ids = [question[0] for question in question_ids]
-        question = None
-        while not question and len(question_ids) > 0:
-            random_index = random.randint(0, len(question_ids) - 1)
-            if question_ids[random_index] in previous_questions:
-                question_ids.pop(random_index)
-            else:
-                question = Question.query.filter(
-                    Question.id == question_ids[random_index]).one_or_none()
-                return jsonify({
-                    'success': True,
-                    'question': question.format()
-                })
-
-        # There are no (new) questions left, so we return None.
+        try:
+            category_id = int(quiz_category['id'])
+            previous_questions = set(previous_questions)
+        except (TypeError, ValueError):
+            abort(400)
+
+        # The quiz index keeps the question ids of every category in memory,
+        # so we only hit the database to load the chosen question.
+        # A category id of zero means all categories.
+        question = quiz_index.pick_question(category_id, previous_questions)
+
+        # If there are no (new) questions left, we return None.
+        return jsonify({
+            'success': True,
+            'question': question
+        })
+
+    '''
+  Endpoint to fetch the next questions of a quiz at once. Takes the same
+  body as /quizzes plus an optional 'count' (QUIZ_BATCH_SIZE by default, at
+  most QUIZ_BATCH_MAX) and returns up to count distinct random questions of
+  the category that are not one of the previous questions, fewer if not as
+  many are left. The ids are picked from the quiz index and the questions
+  loaded with one query, so a whole quiz costs one request.
+  '''
+    @app.route('/quizzes/batch', methods=['POST'])
+    def get_batch_of_questions_to_play_quiz():
+        body = request.get_json()
+        if not body:
+            abort(400)
+
+        previous_questions = body.get('previous_questions')
+        quiz_category = body.get('quiz_category')
+        count = body.get('count', QUIZ_BATCH_SIZE)
+        if (not isinstance(previous_questions, list) or
+                not isinstance(quiz_category, dict) or
+                'id' not in quiz_category or
+                not isinstance(count, int) or isinstance(count, bool) or
+                not 1 <= count <= QUIZ_BATCH_MAX):
+            abort(400)
+
+        try:
+            category_id = int(quiz_category['id'])
+            previous_questions = set(previous_questions)
+        except (TypeError, ValueError):
+            abort(400)
+
+        return jsonify({
+            'success': True,
+            'questions': quiz_index.pick_questions(
+                category_id, previous_questions, count)
+        })
+
+    '''
+  Endpoint to play an adaptive quiz. Like /quizzes it returns a random
+  question that is not one of the previous questions, but from any number
+  of categories ('quiz_categories', or 'quiz_category' as above, all if
+  neither is given) and from a difficulty range ('difficulty' with 'min'
+  and 'max'). Within the range, the difficulty adapts to 'recent_answers',
+  the difficulty and correctness of the player's last answers, and the
+  response reports the targeted difficulty. The question is picked from
+  the quiz index's (category, difficulty) buckets.
+  '''
+    @app.route('/quizzes/adaptive', methods=['POST'])
+    def get_adaptive_quiz_question():
+        body = request.get_json()
+        if not isinstance(body, dict):
+            abort(400)
+
+        previous_questions = body.get('previous_questions', [])
+        category_ids = body.get('quiz_categories')
+        quiz_category = body.get('quiz_category')
+        difficulty = body.get('difficulty') or {}
+        recent_answers = body.get('recent_answers') or []
+        if (not isinstance(previous_questions, list) or
+                not isinstance(category_ids, (list, type(None))) or
+                not isinstance(difficulty, dict) or
+                not isinstance(recent_answers, list) or
+                not all(isinstance(answer, dict)
+                        for answer in recent_answers)):
+            abort(400)
+
+        try:
+            if category_ids is None:
+                category_ids = [quiz_category['id'] if quiz_category
+                                else ALL_CATEGORIES]
+            category_ids = [int(category_id)
+                            for category_id in category_ids]
+            low = int(difficulty.get('min', MIN_DIFFICULTY))
+            high = int(difficulty.get('max', MAX_DIFFICULTY))
+            recent_answers = [(int(answer['difficulty']),
+                               bool(answer['correct']))
+                              for answer in recent_answers]
+            previous_questions = set(previous_questions)
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+        if (not category_ids or low > high or low < MIN_DIFFICULTY or
+                high > MAX_DIFFICULTY):
+            abort(400)
+
+        target = target_difficulty(recent_answers, low, high)
+        question = quiz_index.pick_adaptive_question(
+            category_ids, low, high, target, previous_questions)
+
         return jsonify({
             'success': True,
-            'question': None
+            'question': question,
+            'target_difficulty': target
+        })
+
+    '''
+  Endpoints for server-side quiz sessions. Starting a session samples up to
+  max_questions question ids of the chosen category in random order and
+  returns a token. Every call to next then plays the next question of that
+  order, so the client does not send its previous questions on every round.
+  '''
+    @app.route('/quizzes/sessions', methods=['POST'])
+    def start_quiz_session():
+        body = request.get_json()
+        if not body:
+            abort(400)
+
+        quiz_category = body.get('quiz_category')
+        max_questions = body.get('max_questions', QUIZ_SESSION_QUESTIONS)
+        if (not isinstance(quiz_category, dict) or
+                'id' not in quiz_category or
+                not isinstance(max_questions, int) or
+                isinstance(max_questions, bool) or
+                not 1 <= max_questions <= QUIZ_SESSION_MAX_QUESTIONS):
+            abort(400)
+
+        try:
+            category_id = int(quiz_category['id'])
+        except (TypeError, ValueError):
+            abort(400)
+
+        token, total_questions = quiz_sessions.start(
+            category_id, max_questions)
+
+        return jsonify({
+            'success': True,
+            'session_token': token,
+            'total_questions': total_questions
+        })
+
+    @app.route('/quizzes/sessions/<token>/next', methods=['POST'])
+    def next_quiz_session_question(token):
+        found, question = quiz_sessions.next_question(token)
+        if not found:
+            abort(404)
+
+        return json_response({
+            'success': True,
+            'question': EncodedJSON(question) if question else None
+        })
+
+    @app.route('/quizzes/sessions/<token>', methods=['DELETE'])
+    def end_quiz_session(token):
+        quiz_sessions.end(token)
+
+        return jsonify({
+            'success': True
         })
 
+    compactor.start()
+    start_warm_up(app, warm_up_mode, started)
+    metrics.record_startup('create_app', time.perf_counter() - started)
     return app
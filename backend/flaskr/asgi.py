@@ -0,0 +1,548 @@
+import asyncio
+import json
+import logging
+import re
+import time
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import parse_etags
+
+from models import database_path as default_database_path, db_setting
+from . import create_app
+from .categories import category_cache
+from .http_cache import CACHE_CONTROL, data_etag
+from .limits import retry_after_header
+from .metrics import metrics, record_statement
+from .pagination import (MAX_QUESTIONS_PER_PAGE, QUESTIONS_PER_PAGE,
+                         count_cache, count_key, decode_cursor,
+                         encode_cursor)
+from .quiz import quiz_index
+from .serializers import QuestionRows, dumps, encode_json
+
+logger = logging.getLogger(__name__)
+
+'''
+Asyncio serving mode
+
+create_asgi_app(test_config) returns an ASGI application for an asyncio
+server such as uvicorn:
+
+    uvicorn --factory flaskr.asgi:create_asgi_app
+
+The read and quiz routes that carry most of the traffic (GET /categories,
+GET /questions, GET /categories/<id>/questions and POST /quizzes) are served
+on the event loop with an async driver and pool, asyncpg for PostgreSQL and
+aiosqlite for SQLite, so one worker keeps serving other requests while its
+queries are in flight. Every other request is handed to the Flask app of
+create_app, which runs in a thread pool. Both paths share the in-memory
+caches and indexes and send the same JSON bodies and error bodies.
+'''
+
+ERROR_MESSAGES = {
+    400: 'bad request',
+    404: 'resource not found',
+    405: 'method not allowed',
+    422: 'unprocessable entity',
+    429: 'too many requests',
+    500: 'internal server error',
+    503: 'service unavailable',
+}
+
+CORS_HEADERS = [
+    (b'access-control-allow-headers', b'Content-Type,Authorization,true'),
+    (b'access-control-allow-methods', b'GET,PATCH,POST,DELETE,OPTIONS'),
+]
+
+CATEGORIES_SQL = 'SELECT id, type FROM categories ORDER BY id'
+CATEGORY_EXISTS_SQL = 'SELECT 1 FROM categories WHERE id = $1'
+COUNT_SQL = 'SELECT coalesce(sum(count), 0) FROM question_counts'
+CATEGORY_COUNT_SQL = COUNT_SQL + ' WHERE category = $1'
+QUIZ_INDEX_SQL = ('SELECT id, category, difficulty FROM questions '
+                  'WHERE deleted_at IS NULL ORDER BY id')
+QUESTION_SQL = ('SELECT id, question, answer, category, difficulty '
+                'FROM questions WHERE id = $1 AND deleted_at IS NULL')
+
+
+class HTTPError(Exception):
+
+    def __init__(self, code, retry_after=None):
+        super().__init__(code)
+        self.code = code
+        self.retry_after = retry_after
+
+
+'''
+AsyncDatabase
+    interface of the async connection pools. Queries use PostgreSQL's $1,
+    $2, ... placeholders and return rows as tuples. The pool is opened on
+    first use, so the app can be created outside of the event loop.
+'''
+
+
+class AsyncDatabase:
+
+    def __init__(self, url, pool_size, max_overflow, statement_timeout):
+        self.url = url
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.statement_timeout = statement_timeout
+        self._lock = None
+        self._pool = None
+
+    async def _ensure_pool(self):
+        if self._pool is None:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                if self._pool is None:
+                    self._pool = await self._open()
+        return self._pool
+
+    async def _open(self):
+        raise NotImplementedError
+
+    async def fetch(self, sql, *args):
+        started = time.perf_counter()
+        rows = await self._fetch(sql, *args)
+        record_statement(len(rows), time.perf_counter() - started)
+        return rows
+
+    async def _fetch(self, sql, *args):
+        raise NotImplementedError
+
+    async def fetchval(self, sql, *args):
+        rows = await self.fetch(sql, *args)
+        return rows[0][0] if rows else None
+
+    async def close(self):
+        raise NotImplementedError
+
+
+class PostgresDatabase(AsyncDatabase):
+
+    async def _open(self):
+        import asyncpg
+        server_settings = {}
+        if self.statement_timeout:
+            server_settings['statement_timeout'] = str(self.statement_timeout)
+        return await asyncpg.create_pool(
+            re.sub(r'^postgres(ql)?(\+\w+)?://', 'postgresql://', self.url),
+            min_size=min(self.pool_size, 1),
+            max_size=self.pool_size + self.max_overflow,
+            server_settings=server_settings)
+
+    async def _fetch(self, sql, *args):
+        pool = await self._ensure_pool()
+        return [tuple(record) for record in await pool.fetch(sql, *args)]
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+
+class SQLiteDatabase(AsyncDatabase):
+    '''
+    A fixed set of pool_size aiosqlite connections handed out through a
+    queue. Each aiosqlite connection runs its queries on its own thread.
+    '''
+
+    async def _open(self):
+        import aiosqlite
+        path = re.sub(r'^sqlite(\+\w+)?:///', '', self.url) or ':memory:'
+        pool = asyncio.Queue()
+        for _ in range(max(self.pool_size, 1)):
+            pool.put_nowait(await aiosqlite.connect(path))
+        return pool
+
+    async def _fetch(self, sql, *args):
+        pool = await self._ensure_pool()
+        connection = await pool.get()
+        try:
+            cursor = await connection.execute(
+                re.sub(r'\$\d+', '?', sql), args)
+            rows = await cursor.fetchall()
+            await cursor.close()
+            return [tuple(row) for row in rows]
+        finally:
+            pool.put_nowait(connection)
+
+    async def close(self):
+        if self._pool is not None:
+            while not self._pool.empty():
+                await self._pool.get_nowait().close()
+            self._pool = None
+
+
+def database_from_url(app, url):
+    settings = (db_setting(app, 'DB_POOL_SIZE'),
+                db_setting(app, 'DB_MAX_OVERFLOW'),
+                db_setting(app, 'DB_STATEMENT_TIMEOUT'))
+    if url.startswith('sqlite'):
+        return SQLiteDatabase(url, *settings)
+    return PostgresDatabase(url, *settings)
+
+
+class Request:
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.remote_addr = (scope.get('client') or (None,))[0]
+        self.headers = {name.decode('latin-1'): value.decode('latin-1')
+                        for name, value in scope['headers']}
+        self.args = parse_qs(scope['query_string'].decode('latin-1'),
+                             keep_blank_values=True)
+        self.body = body
+
+    def arg(self, name, default=None, type=None):
+        # Like werkzeug's args.get: the first value, or default if it
+        # doesn't convert.
+        values = self.args.get(name)
+        if not values:
+            return default
+        if type is None:
+            return values[0]
+        try:
+            return type(values[0])
+        except ValueError:
+            return default
+
+    def get_json(self):
+        if not self.headers.get('content-type', '').startswith(
+                'application/json'):
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise HTTPError(400)
+
+
+'''
+AsyncTriviaApp
+    the ASGI application. Routes served natively are listed in ROUTES
+    together with the Flask rule they mirror, which labels their metrics;
+    the cache and index calls they make run inside a Flask app context, so a
+    cache that was invalidated by a thread between our async reload and its
+    use can still reload itself synchronously.
+'''
+
+
+class AsyncTriviaApp:
+
+    ROUTES = [
+        ('GET', '/categories', r'/categories$', 'get_categories'),
+        ('GET', '/questions', r'/questions$', 'get_questions'),
+        ('GET', '/categories/<int:category_id>/questions',
+         r'/categories/(\d+)/questions$', 'get_questions_of_category'),
+        ('POST', '/quizzes', r'/quizzes$', 'get_questions_to_play_quiz'),
+    ]
+
+    def __init__(self, flask_app, database):
+        self.flask_app = flask_app
+        self.database = database
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.server_timing = flask_app.config['SERVER_TIMING']
+        self.rate_limiter = flask_app.extensions['rate_limiter']
+        self.concurrency_limiter = flask_app.extensions['concurrency_limiter']
+        self.limited_endpoints = flask_app.extensions['limited_endpoints']
+        self.routes = [(method, rule, re.compile(pattern), name)
+                       for method, rule, pattern, name in self.ROUTES]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] == 'http':
+            for method, rule, pattern, name in self.routes:
+                match = pattern.match(scope['path'])
+                if match and scope['method'] == method:
+                    await self.dispatch(scope, receive, send, rule, name,
+                                        match.groups())
+                    return
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.database.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch(self, scope, receive, send, rule, name, groups):
+        metrics.start_request()
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+        request = Request(scope, body)
+        admitted = False
+        try:
+            if name in self.limited_endpoints:
+                # The limiters may block, on a Redis round trip or while
+                # waiting for a slot, so they run off the event loop.
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.admit, request, name)
+                admitted = True
+            status, headers, body = await getattr(self, name)(
+                request, *groups)
+        except HTTPError as error:
+            status, headers, body = self.error(error.code, error.retry_after)
+        except Exception:
+            logger.exception('Exception on %s [%s]',
+                             request.path, request.method)
+            status, headers, body = self.error(500)
+        finally:
+            if admitted:
+                self.concurrency_limiter.release()
+
+        headers = list(headers) + CORS_HEADERS
+        request_metrics, duration = metrics.finish_request(
+            request.method, rule, status)
+        if self.server_timing:
+            headers.append((b'server-timing', request_metrics.server_timing(
+                duration).encode('ascii')))
+        origin = request.headers.get('origin')
+        if origin:
+            headers += [(b'access-control-allow-origin',
+                         origin.encode('latin-1')),
+                        (b'vary', b'Origin')]
+        else:
+            headers.append((b'access-control-allow-origin', b'*'))
+        body = body.encode('utf-8')
+        if status != 304:
+            headers.append((b'content-type', b'application/json'))
+        headers.append((b'content-length', str(len(body)).encode('ascii')))
+
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def admit(self, request, name):
+        '''
+        Applies the rate limits and admission control of the Flask app's
+        admit_request to a request to the endpoint name.
+        '''
+        if self.rate_limiter is not None:
+            retry_after = self.rate_limiter.check(request.remote_addr, name)
+            if retry_after:
+                raise HTTPError(429, retry_after_header(retry_after))
+        if not self.concurrency_limiter.acquire():
+            raise HTTPError(503, 1)
+
+    def error(self, code, retry_after=None):
+        headers = []
+        if retry_after:
+            headers.append((b'retry-after', str(retry_after).encode('ascii')))
+        return code, headers, dumps({
+            'success': False,
+            'error': code,
+            'message': ERROR_MESSAGES[code]
+        }) + '\n'
+
+    def in_app_context(self, function, *args):
+        with self.flask_app.app_context():
+            return function(*args)
+
+    async def conditional_get(self, request, versions):
+        '''
+        Returns the ETag headers of a response built from the data versions
+        and whether the request's If-None-Match already holds that ETag.
+        '''
+        response_cache = self.flask_app.extensions['response_cache']
+        if response_cache.backend.shared:
+            # The versions are read from Redis, off the event loop.
+            etag = await asyncio.get_running_loop().run_in_executor(
+                None, data_etag, response_cache, versions)
+        else:
+            etag = data_etag(response_cache, versions)
+        headers = [(b'etag', ('"%s"' % etag).encode('ascii')),
+                   (b'cache-control', CACHE_CONTROL.encode('ascii'))]
+        not_modified = parse_etags(
+            request.headers.get('if-none-match')).contains(etag)
+        return headers, not_modified
+
+    async def load_categories(self):
+        if category_cache.needs_load():
+            category_cache.load_rows(await self.database.fetch(CATEGORIES_SQL))
+
+    async def total_questions(self, category_id=None):
+        key = count_key(category_id)
+        total = count_cache.lookup(key)
+        if total is None:
+            if category_id is None:
+                total = await self.database.fetchval(COUNT_SQL)
+            else:
+                total = await self.database.fetchval(
+                    CATEGORY_COUNT_SQL, category_id)
+            total = int(total)
+            count_cache.store(key, total)
+        return total
+
+    async def paginate(self, request, category_id=None):
+        '''
+        The async counterpart of paginate_questions for listings sorted by
+        id, with the same '?page=', '?cursor=', '?after_id=' and '?limit='
+        arguments.
+        '''
+        limit = request.arg('limit', QUESTIONS_PER_PAGE, type=int)
+        if limit < 1:
+            raise HTTPError(400)
+        limit = min(limit, MAX_QUESTIONS_PER_PAGE)
+        page = request.arg('page', 1, type=int)
+        after_id = request.arg('after_id', None, type=int)
+        cursor = request.arg('cursor')
+
+        where = ['deleted_at IS NULL']
+        args = []
+        if category_id is not None:
+            args.append(category_id)
+            where.append('category = $%d' % len(args))
+
+        offset = 0
+        if cursor is not None:
+            position = decode_cursor(cursor)
+            if position is None:
+                raise HTTPError(400)
+            after_id = position[1]
+        elif after_id is None:
+            if page < 1:
+                total = await self.total_questions(category_id)
+                return QuestionRows(), total, None
+            offset = (page - 1) * limit
+        if after_id is not None:
+            args.append(after_id)
+            where.append('id > $%d' % len(args))
+
+        sql = 'SELECT id, question, answer, category, difficulty ' \
+              'FROM questions WHERE ' + ' AND '.join(where)
+        args += [limit + 1, offset]
+        sql += ' ORDER BY id LIMIT $%d OFFSET $%d' % (
+            len(args) - 1, len(args))
+        questions = await self.database.fetch(sql, *args)
+
+        next_cursor = None
+        if len(questions) > limit:
+            questions = questions[:limit]
+            next_cursor = encode_cursor(questions[-1][0], questions[-1][0])
+        total = await self.total_questions(category_id)
+        return QuestionRows(questions), total, next_cursor
+
+    async def get_categories(self, request):
+        headers, not_modified = await self.conditional_get(
+            request, ['categories'])
+        if not_modified:
+            return 304, headers, ''
+        await self.load_categories()
+        return 200, headers, self.in_app_context(category_cache.json)
+
+    async def get_questions(self, request):
+        headers, not_modified = await self.conditional_get(
+            request, ['generation', 'questions', 'categories'])
+        if not_modified:
+            return 304, headers, ''
+
+        questions, total, next_cursor = await self.paginate(request)
+        if len(questions) == 0:
+            raise HTTPError(404)
+
+        await self.load_categories()
+        return 200, headers, encode_json({
+            'success': True,
+            'questions': questions,
+            'total_questions': total,
+            'next_cursor': next_cursor,
+            'current_category': '0',
+            'categories': self.in_app_context(category_cache.get)
+        })
+
+    async def get_questions_of_category(self, request, category_id):
+        category_id = int(category_id)
+        headers, not_modified = await self.conditional_get(
+            request, ['generation', 'category:' + str(category_id),
+                      'categories'])
+        if not_modified:
+            return 304, headers, ''
+
+        await self.load_categories()
+        if not self.in_app_context(category_cache.exists, category_id):
+            if await self.database.fetchval(
+                    CATEGORY_EXISTS_SQL, category_id) is None:
+                raise HTTPError(404)
+            category_cache.invalidate()
+
+        questions, total, next_cursor = await self.paginate(
+            request, category_id)
+        if len(questions) == 0 and request.arg('page', 1, type=int) > 1:
+            raise HTTPError(404)
+
+        return 200, headers, encode_json({
+            'success': True,
+            'questions': questions,
+            'total_questions': total,
+            'next_cursor': next_cursor,
+            'current_category': category_id
+        })
+
+    async def get_questions_to_play_quiz(self, request):
+        body = request.get_json()
+        if not body or not isinstance(body, dict):
+            raise HTTPError(400)
+
+        previous_questions = body.get('previous_questions')
+        quiz_category = body.get('quiz_category')
+        if (not isinstance(previous_questions, list) or
+                not isinstance(quiz_category, dict) or
+                'id' not in quiz_category):
+            raise HTTPError(400)
+
+        try:
+            category_id = int(quiz_category['id'])
+            previous_questions = set(previous_questions)
+        except (TypeError, ValueError):
+            raise HTTPError(400)
+
+        if quiz_index.needs_load():
+            quiz_index.load_rows(await self.database.fetch(QUIZ_INDEX_SQL))
+
+        question = None
+        while True:
+            question_id = self.in_app_context(
+                quiz_index.pick_id, category_id, previous_questions)
+            if question_id is None:
+                break
+            rows = await self.database.fetch(QUESTION_SQL, question_id)
+            if rows:
+                question = rows[0]
+                break
+            # Deleted by another process since the index was loaded.
+            quiz_index.remove(question_id)
+
+        if question is not None:
+            question = dict(zip(
+                ('id', 'question', 'answer', 'category', 'difficulty'),
+                question))
+        return 200, [], dumps({
+            'success': True,
+            'question': question
+        }) + '\n'
+
+
+def create_asgi_app(test_config=None):
+    '''
+    Creates the Flask app with create_app(test_config) and wraps it in the
+    asyncio serving mode. ASYNC_DATABASE_URL in test_config overrides the
+    database url (DATABASE_URL by default).
+    '''
+    flask_app = create_app(test_config)
+    url = flask_app.config.get('ASYNC_DATABASE_URL') or \
+        flask_app.config.get('SQLALCHEMY_DATABASE_URI') or \
+        default_database_path
+    return AsyncTriviaApp(flask_app, database_from_url(flask_app, url))
@@ -0,0 +1,192 @@
+import codecs
+import csv
+import io
+import json
+from collections import Counter
+
+from models import db, Question, adjust_question_counts, notify_question_write
+from .categories import category_cache
+from .serializers import encode_question, select_questions, stream_questions
+
+BULK_BATCH_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+
+BULK_COLUMNS = ['question', 'answer', 'difficulty', 'category']
+EXPORT_COLUMNS = ['id'] + BULK_COLUMNS
+
+
+'''
+Bulk import
+    rows are read one line at a time from the request stream, validated and
+    written in batches of BULK_BATCH_SIZE: with COPY on PostgreSQL and a
+    single executemany INSERT elsewhere. Invalid rows are reported with their
+    line number and skipped, they never abort the import. If the database
+    rejects a batch, its rows are retried one by one so only the offending
+    rows fail.
+'''
+
+
+def read_ndjson(lines):
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_number, None, 'invalid JSON'
+            continue
+        if not isinstance(row, dict):
+            yield line_number, None, 'expected a JSON object'
+            continue
+        yield line_number, row, None
+
+
+def read_csv(lines):
+    reader = csv.DictReader(lines)
+    for row in reader:
+        # The header is line 1, so data rows start at line 2.
+        yield reader.line_num, row, None
+
+
+def validate_row(row):
+    question = row.get('question')
+    answer = row.get('answer')
+    if not isinstance(question, str) or not question.strip():
+        return None, 'question is required'
+    if not isinstance(answer, str) or not answer.strip():
+        return None, 'answer is required'
+    try:
+        difficulty = int(row.get('difficulty'))
+        category = int(row.get('category'))
+    except (TypeError, ValueError):
+        return None, 'difficulty and category must be integers'
+    if not category_cache.exists(category):
+        return None, 'category does not exist'
+    return {
+        'question': question,
+        'answer': answer,
+        'difficulty': difficulty,
+        'category': category
+    }, None
+
+
+def _copy_rows(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in BULK_COLUMNS])
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY questions (question, answer, difficulty, category) '
+            'FROM STDIN WITH (FORMAT csv)', buffer)
+    finally:
+        cursor.close()
+
+
+def _write_batch(batch, report):
+    rows = [row for line_number, row in batch]
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            _copy_rows(rows)
+        else:
+            db.session.execute(Question.__table__.insert(), rows)
+        adjust_question_counts(Counter(
+            (row['category'], row['difficulty']) for row in rows))
+        db.session.commit()
+        report['inserted'] += len(rows)
+        return
+    except Exception:
+        db.session.rollback()
+
+    for line_number, row in batch:
+        try:
+            db.session.execute(Question.__table__.insert(), [row])
+            adjust_question_counts({(row['category'], row['difficulty']): 1})
+            db.session.commit()
+            report['inserted'] += 1
+        except Exception:
+            db.session.rollback()
+            _add_error(report, line_number, 'rejected by the database')
+
+
+def _add_error(report, line_number, error):
+    report['failed'] += 1
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+        report['errors'].append({'line': line_number, 'error': error})
+
+
+def import_questions(stream, format):
+    '''
+    Imports the questions of a binary stream in NDJSON or CSV format and
+    returns a report with the number of inserted and failed rows and the
+    errors of (at most MAX_REPORTED_ERRORS) failed rows.
+    '''
+    lines = codecs.iterdecode(stream, 'utf-8')
+    rows = read_csv(lines) if format == 'csv' else read_ndjson(lines)
+
+    report = {'inserted': 0, 'failed': 0, 'errors': []}
+    batch = []
+    try:
+        for line_number, row, error in rows:
+            if error is None:
+                row, error = validate_row(row)
+            if error is not None:
+                _add_error(report, line_number, error)
+                continue
+            batch.append((line_number, row))
+            if len(batch) >= BULK_BATCH_SIZE:
+                _write_batch(batch, report)
+                batch = []
+    except (UnicodeDecodeError, csv.Error):
+        _add_error(report, None, 'unreadable input, import stopped')
+
+    if batch:
+        _write_batch(batch, report)
+    if report['inserted']:
+        notify_question_write('reload', None)
+    return report
+
+
+'''
+Export
+    streams every question in id order as NDJSON, CSV or a single JSON
+    object. The rows are read through a server-side cursor in batches of
+    EXPORT_BATCH_SIZE, so the table is never held in memory at once.
+'''
+
+
+def export_questions(format):
+    rows = select_questions(Question.live()).order_by(
+        Question.id).execution_options(
+        stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+
+    if format == 'json':
+        yield from stream_questions({'success': True}, rows)
+        return
+
+    if format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        for row in rows:
+            writer.writerow([getattr(row, column)
+                             for column in EXPORT_COLUMNS])
+            if buffer.tell() >= 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+        return
+
+    chunk = []
+    for row in rows:
+        chunk.append(encode_question(row))
+        if len(chunk) >= EXPORT_BATCH_SIZE:
+            yield '\n'.join(chunk) + '\n'
+            chunk = []
+    if chunk:
+        yield '\n'.join(chunk) + '\n'
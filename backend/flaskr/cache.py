@@ -0,0 +1,227 @@
+import functools
+import secrets
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import event
+
+from models import Category, on_question_write
+
+RESPONSE_CACHE_TTL = 30
+RESPONSE_CACHE_MAX_ENTRIES = 10000
+
+
+'''
+CacheBackend
+    interface of the response cache stores, modelled on the Redis commands
+    GET, SET with EX and DEL so that a Redis server can be shared by all
+    workers. shared tells whether all workers see the same store.
+'''
+
+
+class CacheBackend:
+
+    evictions = 0
+    shared = False
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def stats(self):
+        return {
+            'backend': type(self).__name__,
+            'evictions': self.evictions
+        }
+
+
+'''
+MemoryCache
+    in-process backend: a dict in least recently used order that evicts the
+    oldest entries beyond max_entries and drops entries older than their
+    ttl when they are read.
+'''
+
+
+class MemoryCache(CacheBackend):
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        stats = super().stats()
+        stats['entries'] = len(self._entries)
+        stats['max_entries'] = self.max_entries
+        return stats
+
+
+'''
+RedisCache
+    shared backend on top of any client with the redis-py interface (get,
+    set with ex and delete), e.g. redis.Redis or a fake in tests. Evictions
+    happen inside Redis (maxmemory-policy allkeys-lru), so they are not
+    counted here.
+'''
+
+
+class RedisCache(CacheBackend):
+
+    shared = True
+
+    def __init__(self, client, prefix='trivia:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+def backend_from_url(url):
+    '''
+    Returns a RedisCache for a redis:// url, which needs the optional redis
+    package, or a MemoryCache if url is empty.
+    '''
+    if not url:
+        return MemoryCache()
+    import redis
+    return RedisCache(redis.Redis.from_url(url))
+
+
+'''
+ResponseCache
+    caches serialized response bodies of the read endpoints. Keys live in
+    namespaces ('questions', 'search', 'category:<id>', 'categories') whose
+    version is stored in the backend. Invalidating a namespace stores a new
+    random version, which orphans every key of the namespace without having
+    to find them; orphans age out through LRU eviction and their ttl.
+    Versions are random rather than counters, so a version that was evicted
+    and recreated can never bring old entries back. The 'generation'
+    version is part of every key and invalidates everything at once.
+
+    Every app has a ResponseCache of its own (app.extensions
+    ['response_cache']); question and category writes invalidate all of
+    those of the process.
+'''
+
+_response_caches = weakref.WeakSet()
+
+
+class ResponseCache:
+
+    def __init__(self, backend=None, ttl=RESPONSE_CACHE_TTL):
+        self.ttl = ttl
+        self.backend = backend if backend is not None else MemoryCache()
+        self.hits = 0
+        self.misses = 0
+        _response_caches.add(self)
+
+    def version(self, namespace):
+        version = self.backend.get('version:' + namespace)
+        if version is None:
+            version = self.invalidate(namespace)
+        return version
+
+    def _key(self, namespace, key):
+        return 'response:%s:%s:%s:%s' % (
+            self.version('generation'), namespace,
+            self.version(namespace), key)
+
+    def invalidate(self, namespace):
+        version = secrets.token_hex(4)
+        self.backend.set('version:' + namespace, version)
+        return version
+
+    def cached(self, namespace, key):
+        '''
+        Decorates a view so its successful JSON bodies are cached under
+        namespace(**view_args) and key(**view_args).
+        '''
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                cache_key = self._key(namespace(**kwargs), key(**kwargs))
+                body = self.backend.get(cache_key)
+                if body is not None:
+                    self.hits += 1
+                    return current_app.response_class(
+                        body, mimetype='application/json')
+
+                self.misses += 1
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code == 200:
+                    self.backend.set(
+                        cache_key, response.get_data(as_text=True), self.ttl)
+                return response
+            return wrapper
+        return decorator
+
+    def stats(self):
+        stats = self.backend.stats()
+        stats['hits'] = self.hits
+        stats['misses'] = self.misses
+        return stats
+
+
+@on_question_write
+def _invalidate_responses(action, question):
+    for response_cache in list(_response_caches):
+        if action in ('insert', 'delete'):
+            response_cache.invalidate('questions')
+            response_cache.invalidate('search')
+            response_cache.invalidate(
+                'category:' + str(question['category']))
+        else:
+            response_cache.invalidate('generation')
+
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def _invalidate_category_responses(mapper, connection, target):
+    for response_cache in list(_response_caches):
+        response_cache.invalidate('categories')
+        response_cache.invalidate('generation')
@@ -0,0 +1,84 @@
+import json
+import threading
+import time
+
+from sqlalchemy import event
+
+from models import Category
+
+CATEGORY_CACHE_TTL = 300
+
+
+'''
+CategoryCache
+    keeps the categories in memory for up to ttl seconds, both as the
+    {id: type} dict embedded in question listings and as the precomputed
+    JSON body of GET /categories. Categories almost never change, so most
+    requests skip the categories query entirely. Any write to the categories
+    table invalidates the cache.
+'''
+
+
+class CategoryCache:
+
+    def __init__(self, ttl=CATEGORY_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._state = None
+
+    def _load(self):
+        return self.load_rows(Category.query.with_entities(
+            Category.id, Category.type).order_by(Category.id))
+
+    def load_rows(self, rows):
+        '''
+        Fills the cache from (id, type) rows loaded elsewhere, e.g. by the
+        asyncio serving mode.
+        '''
+        categories_dict = {}
+        for category_id, category_type in rows:
+            categories_dict[category_id] = category_type
+
+        body = json.dumps({
+            'success': True,
+            'categories': categories_dict
+        }, sort_keys=True)
+        self._state = (categories_dict, body, time.monotonic())
+        return self._state
+
+    def _is_fresh(self, state):
+        return state is not None and time.monotonic() - state[2] < self.ttl
+
+    def needs_load(self):
+        return not self._is_fresh(self._state)
+
+    def _get_state(self):
+        state = self._state
+        if not self._is_fresh(state):
+            with self._lock:
+                state = self._state
+                if not self._is_fresh(state):
+                    state = self._load()
+        return state
+
+    def get(self):
+        return self._get_state()[0]
+
+    def json(self):
+        return self._get_state()[1]
+
+    def exists(self, category_id):
+        return category_id in self.get()
+
+    def invalidate(self):
+        self._state = None
+
+
+category_cache = CategoryCache()
+
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def _invalidate_categories(mapper, connection, target):
+    category_cache.invalidate()
@@ -0,0 +1,54 @@
+import threading
+from datetime import datetime, timedelta
+
+from models import db_setting, purge_deleted_questions
+
+'''
+Compactor
+    purges the tombstones that Question.delete leaves behind once they are
+    older than retention seconds, batch_size rows per transaction. start()
+    runs it every interval seconds in a daemon thread; every worker may run
+    one, since purging the same rows twice only finds nothing to do the
+    second time. 'flask compact-questions' runs it once.
+'''
+
+
+class Compactor:
+
+    def __init__(self, app, interval, retention, batch_size):
+        self.app = app
+        self.interval = interval
+        self.retention = retention
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_settings(cls, app):
+        return cls(app, db_setting(app, 'DB_COMPACTION_INTERVAL'),
+                   db_setting(app, 'DB_TOMBSTONE_RETENTION'),
+                   db_setting(app, 'DB_COMPACTION_BATCH_SIZE'))
+
+    def run_once(self):
+        '''
+        Purges the tombstones that are old enough and returns how many.
+        '''
+        deleted_before = datetime.utcnow() - timedelta(seconds=self.retention)
+        with self.app.app_context():
+            return purge_deleted_questions(deleted_before, self.batch_size)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                self.app.logger.exception('Purging deleted questions failed')
+
+    def start(self):
+        if self.interval and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='compaction', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
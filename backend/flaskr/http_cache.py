@@ -0,0 +1,62 @@
+import functools
+import time
+
+from flask import current_app, request
+
+CACHE_CONTROL = 'public, max-age=0, must-revalidate'
+ETAG_LIFETIME = 30
+
+
+'''
+Data versions
+    a response's ETag is built from the versions of the data it depends on:
+    the namespace versions of the app's ResponseCache, which every write
+    replaces ('questions' and 'category:<id>' for question inserts and
+    deletes, 'generation' for updates and bulk imports, 'categories' for the
+    categories table). Checking If-None-Match therefore needs no database
+    access.
+
+    With a shared backend (RESPONSE_CACHE_URL), all workers read the same
+    versions and see each other's writes, so any worker can answer 304 to
+    an ETag handed out by another. The in-process backend only sees the
+    writes of its own process and is meant for a single worker: its ETags
+    also carry the current ETAG_LIFETIME window, which bounds how long a
+    worker of a multi-worker deployment may answer 304 for data changed by
+    another worker.
+'''
+
+
+def data_etag(response_cache, keys):
+    etag = '.'.join(response_cache.version(key) for key in keys)
+    if not response_cache.backend.shared:
+        etag += '-%d' % (time.time() // ETAG_LIFETIME)
+    return etag
+
+
+'''
+conditional_get(versions)
+    decorates a view so its successful responses carry a strong ETag built
+    from the data versions returned by versions(**view_args), together with
+    CACHE_CONTROL. Requests whose If-None-Match holds the current ETag get
+    an empty 304 response without calling the view.
+'''
+
+
+def conditional_get(versions):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = data_etag(current_app.extensions['response_cache'],
+                             versions(**kwargs))
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = CACHE_CONTROL
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,213 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from models import db_setting, setting
+
+# Tokens per second and burst size of the token bucket of each client on
+# each of the expensive endpoints.
+RATE_LIMITS = {
+    'create_question': (1, 10),
+    'import_question_bulk': (0.1, 2),
+    'search_for_question': (5, 20),
+    'get_questions_to_play_quiz': (10, 30),
+    'get_batch_of_questions_to_play_quiz': (2, 10),
+    'get_adaptive_quiz_question': (10, 30),
+}
+RATE_LIMIT_MAX_BUCKETS = 100000
+
+'''
+Admission settings, read from the app config or else from the environment:
+
+RATE_LIMITING               limit the requests per client on the endpoints
+                            of RATE_LIMITS (true/false)
+RATE_LIMIT_URL              redis:// url of a store shared by all workers,
+                            in process if empty
+ADMISSION_MAX_CONCURRENT    requests to the endpoints of RATE_LIMITS served
+                            at once, DB_POOL_SIZE by default
+ADMISSION_TIMEOUT           seconds a request waits for its turn before it
+                            is turned away with 503
+'''
+LIMIT_SETTINGS = {
+    'RATE_LIMITING': (bool, True),
+    'RATE_LIMIT_URL': (str, ''),
+    'ADMISSION_MAX_CONCURRENT': (int, None),
+    'ADMISSION_TIMEOUT': (float, 1.0),
+}
+
+
+def limit_setting(app, name):
+    return setting(app, LIMIT_SETTINGS, name)
+
+
+'''
+RateLimitStore
+    interface of the stores that keep the token buckets. take(key, rate,
+    burst) refills the bucket of key with rate tokens per second up to
+    burst, takes a token if there is one and returns 0, or else returns the
+    seconds until the next token.
+'''
+
+
+class RateLimitStore:
+
+    def take(self, key, rate, burst):
+        raise NotImplementedError
+
+
+'''
+MemoryRateLimitStore
+    keeps the buckets of one process in a dict in least recently used order,
+    forgetting the oldest beyond max_buckets. A forgotten bucket comes back
+    full, which only ever lets a client through.
+'''
+
+
+class MemoryRateLimitStore(RateLimitStore):
+
+    def __init__(self, max_buckets=RATE_LIMIT_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            retry_after = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+'''
+RedisRateLimitStore
+    shared store on top of any client with the redis-py interface. Each
+    bucket is a hash updated atomically by a Lua script and expires once it
+    would be full again.
+'''
+
+TOKEN_BUCKET_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(retry_after)
+'''
+
+
+class RedisRateLimitStore(RateLimitStore):
+
+    def __init__(self, client, prefix='trivia:rate:'):
+        self.client = client
+        self.prefix = prefix
+        self._script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self._script(keys=[self.prefix + key],
+                                  args=[rate, burst, repr(time.time())]))
+
+
+def store_from_url(url):
+    '''
+    Returns a RedisRateLimitStore for a redis:// url, which needs the
+    optional redis package, or a MemoryRateLimitStore if url is empty.
+    '''
+    if not url:
+        return MemoryRateLimitStore()
+    import redis
+    return RedisRateLimitStore(redis.Redis.from_url(url))
+
+
+'''
+RateLimiter
+    token bucket rate limits per client and endpoint. Endpoints without an
+    entry in limits are not limited.
+'''
+
+
+class RateLimiter:
+
+    def __init__(self, limits=RATE_LIMITS, store=None):
+        self.limits = limits
+        self.store = store if store is not None else MemoryRateLimitStore()
+
+    def check(self, client, endpoint):
+        '''
+        Returns 0 if client may call endpoint now, or else the seconds until
+        it may.
+        '''
+        limit = self.limits.get(endpoint)
+        if limit is None:
+            return 0
+        rate, burst = limit
+        return self.store.take('%s:%s' % (endpoint, client), rate, burst)
+
+
+'''
+ConcurrencyLimiter
+    admission control: at most limit requests hold a slot at once, and a
+    request that can't get one within timeout seconds is shed. Sized below
+    the connection pool, this keeps a burst of expensive requests from
+    taking every connection, so that they queue here for a bounded time
+    instead of in the pool, and cheap requests keep being served.
+'''
+
+
+class ConcurrencyLimiter:
+
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(limit)
+        self.shed = 0
+
+    def acquire(self):
+        if self._slots.acquire(timeout=self.timeout):
+            return True
+        self.shed += 1
+        return False
+
+    def release(self):
+        self._slots.release()
+
+
+def retry_after_header(seconds):
+    return max(int(math.ceil(seconds)), 1)
+
+
+def create_limiters(app):
+    '''
+    Returns the RateLimiter (None if rate limiting is off) and the
+    ConcurrencyLimiter of the app's settings. RATE_LIMITS in the app config
+    overrides the limited endpoints and their limits.
+    '''
+    rate_limiter = None
+    if limit_setting(app, 'RATE_LIMITING'):
+        rate_limiter = RateLimiter(
+            app.config.get('RATE_LIMITS', RATE_LIMITS),
+            store_from_url(limit_setting(app, 'RATE_LIMIT_URL')))
+    max_concurrent = limit_setting(app, 'ADMISSION_MAX_CONCURRENT')
+    if max_concurrent is None:
+        max_concurrent = db_setting(app, 'DB_POOL_SIZE')
+    return rate_limiter, ConcurrencyLimiter(
+        max_concurrent, limit_setting(app, 'ADMISSION_TIMEOUT'))
@@ -0,0 +1,265 @@
+import contextlib
+import contextvars
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+'''
+Histogram
+    a Prometheus histogram with one series per label tuple. Each series
+    keeps the count of observations per bucket (not cumulative, the
+    running sums are taken when rendering), their sum and their count.
+'''
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = defaultdict(lambda: [0] * (len(buckets) + 3))
+
+    def observe(self, label_values, value):
+        series = self._series[label_values]
+        position = len(self.buckets)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                position = index
+                break
+        series[position] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        for label_values, series in sorted(self._series.items()):
+            labels = format_labels(self.labels, label_values)
+            cumulative = 0
+            bounds = [repr(float(bound)) for bound in self.buckets]
+            for bound, count in zip(bounds + ['+Inf'], series):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (
+                    self.name, labels, bound, cumulative))
+            lines.append('%s_sum{%s} %r' % (self.name, labels, series[-2]))
+            lines.append('%s_count{%s} %d' % (self.name, labels, series[-1]))
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = defaultdict(int)
+
+    def inc(self, label_values, value=1):
+        self._series[label_values] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s counter' % self.name]
+        for label_values, value in sorted(self._series.items()):
+            lines.append('%s{%s} %d' % (
+                self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Gauge:
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = {}
+
+    def set(self, label_values, value):
+        self._series[label_values] = value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s gauge' % self.name]
+        for label_values, value in sorted(self._series.items()):
+            lines.append('%s{%s} %r' % (
+                self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+
+def format_labels(names, values):
+    return ','.join('%s="%s"' % (name, str(value).replace(
+        '\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(names, values))
+
+
+'''
+RequestMetrics
+    what a single request spent: its start time, the SQL statements it ran
+    with the time spent in them and the rows they returned, and the time
+    spent encoding JSON. The metrics of the running request live in a
+    context variable, so they follow the request on its thread (WSGI) or
+    task (asyncio serving mode).
+'''
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.rows = 0
+        self.database_time = 0.0
+        self.serialization_time = 0.0
+
+    def server_timing(self, duration):
+        return ('app;dur=%.2f, db;dur=%.2f;desc="%d statements", '
+                'serialize;dur=%.2f' % (
+                    duration * 1000, self.database_time * 1000,
+                    self.statements, self.serialization_time * 1000))
+
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+'''
+Metrics
+    the registry of all request metrics, labelled by method and route rule
+    (e.g. '/categories/<int:category_id>/questions'), never by raw path, so
+    the number of series stays bounded, and of the startup phases of the
+    process's app.
+'''
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter(
+            'trivia_requests_total', 'Requests handled.',
+            ('method', 'route', 'status'))
+        self.latency = Histogram(
+            'trivia_request_duration_seconds', 'Request latency.',
+            ('method', 'route'), LATENCY_BUCKETS)
+        self.statements = Histogram(
+            'trivia_request_sql_statements', 'SQL statements per request.',
+            ('method', 'route'), STATEMENT_BUCKETS)
+        self.rows = Histogram(
+            'trivia_request_sql_rows', 'Rows returned by SQL per request.',
+            ('method', 'route'), ROW_BUCKETS)
+        self.database_time = Histogram(
+            'trivia_request_sql_duration_seconds',
+            'Time spent in SQL per request.',
+            ('method', 'route'), LATENCY_BUCKETS)
+        self.serialization_time = Histogram(
+            'trivia_request_serialization_duration_seconds',
+            'Time spent encoding JSON per request.',
+            ('method', 'route'), LATENCY_BUCKETS)
+        self.startup = Gauge(
+            'trivia_startup_seconds',
+            'Seconds from the start of create_app to the end of each startup '
+            'phase.', ('phase',))
+
+    def start_request(self):
+        request_metrics = RequestMetrics()
+        _current.set(request_metrics)
+        return request_metrics
+
+    def finish_request(self, method, route, status):
+        '''
+        Records the running request and returns its RequestMetrics and
+        duration, or (None, None) if no request was started.
+        '''
+        request_metrics = _current.get()
+        if request_metrics is None:
+            return None, None
+        _current.set(None)
+        duration = time.perf_counter() - request_metrics.started
+        labels = (method, route)
+        with self._lock:
+            self.requests.inc((method, route, status))
+            self.latency.observe(labels, duration)
+            self.statements.observe(labels, request_metrics.statements)
+            self.rows.observe(labels, request_metrics.rows)
+            self.database_time.observe(
+                labels, request_metrics.database_time)
+            self.serialization_time.observe(
+                labels, request_metrics.serialization_time)
+        return request_metrics, duration
+
+    def record_startup(self, phase, seconds):
+        with self._lock:
+            self.startup.set((phase,), seconds)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metric in (self.requests, self.latency, self.statements,
+                           self.rows, self.database_time,
+                           self.serialization_time, self.startup):
+                lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def record_statement(rows, duration):
+    request_metrics = _current.get()
+    if request_metrics is not None:
+        request_metrics.statements += 1
+        request_metrics.rows += rows
+        request_metrics.database_time += duration
+
+
+@contextlib.contextmanager
+def serialization_timer():
+    '''
+    Adds the time spent in the with block to the serialization time of the
+    running request.
+    '''
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        request_metrics = _current.get()
+        if request_metrics is not None:
+            request_metrics.serialization_time += \
+                time.perf_counter() - started
+
+
+'''
+Every statement run through SQLAlchemy is counted for the running request.
+The DB-API reports the rows of a SELECT in cursor.rowcount for buffered
+cursors (psycopg2); drivers that don't know it (SQLite, server-side
+cursors) report -1, and their rows are not counted. The start time is kept
+on the statement's execution context, so statements that fail, and never
+reach after_cursor_execute, leave nothing behind.
+'''
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    context._metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _finish_statement(conn, cursor, statement, parameters, context,
+                      executemany):
+    started = context._metrics_started
+    rows = 0
+    if cursor.description is not None and cursor.rowcount > 0:
+        rows = cursor.rowcount
+    record_statement(rows, time.perf_counter() - started)
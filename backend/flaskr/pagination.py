@@ -0,0 +1,239 @@
+import base64
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import abort
+from sqlalchemy import tuple_
+
+from models import Question, on_question_write
+from .serializers import QuestionRows, fetch_rows, select_questions
+from .stats import count_questions
+
+QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+COUNT_CACHE_TTL = 30
+COUNT_CACHE_MAX_ENTRIES = 1024
+
+
+'''
+CountCache
+    keeps question totals for a short time, keyed by a string describing
+    the listing (e.g. 'questions' or 'category:3'), so paging through a
+    listing does not read the totals on every request. Question inserts and
+    deletes adjust the cached counts in place.
+'''
+
+
+class CountCache:
+
+    def __init__(self, ttl=COUNT_CACHE_TTL,
+                 max_entries=COUNT_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._counts = OrderedDict()
+
+    def get(self, key, count_function):
+        count = self.lookup(key)
+        if count is None:
+            count = count_function()
+            self.store(key, count)
+        return count
+
+    def lookup(self, key):
+        with self._lock:
+            # Popping and reinserting moves the entry to the end; expired
+            # entries are dropped and, like missing ones, are a miss.
+            try:
+                entry = self._counts.pop(key)
+            except KeyError:
+                return None
+            if time.monotonic() - entry[1] >= self.ttl:
+                return None
+            self._counts[key] = entry
+            return entry[0]
+
+    def store(self, key, count):
+        with self._lock:
+            self._counts.pop(key, None)
+            self._counts[key] = (count, time.monotonic())
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+
+    def adjust(self, key, delta):
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is not None:
+                self._counts[key] = (entry[0] + delta, entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+count_cache = CountCache()
+
+Page = namedtuple('Page', ['questions', 'total_questions', 'next_cursor'])
+
+
+def count_key(category_id=None):
+    if category_id is None:
+        return 'questions'
+    return 'category:' + str(category_id)
+
+
+def total_questions(category_id=None):
+    '''
+    Returns the number of questions, or of the questions of a category,
+    from count_cache or else from the question_counts table.
+    '''
+    return count_cache.get(count_key(category_id),
+                           lambda: count_questions(category_id))
+
+
+@on_question_write
+def _update_counts(action, question):
+    if action in ('update', 'reload'):
+        # The category may have changed, which moves the question between
+        # listings we can't tell apart here.
+        count_cache.clear()
+        return
+
+    delta = 1 if action == 'insert' else -1
+    count_cache.adjust(count_key(), delta)
+    count_cache.adjust(count_key(question['category']), delta)
+
+
+'''
+Cursors are opaque continuation tokens encoding the (sort key, id) of the
+last question of a page. Resuming from a cursor is a keyset filter, so page
+N costs the same as page 1.
+'''
+
+
+def encode_cursor(sort_key, question_id):
+    payload = json.dumps([sort_key, question_id], separators=(',', ':'))
+    token = base64.urlsafe_b64encode(payload.encode('utf-8'))
+    return token.decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        sort_key, question_id = json.loads(
+            base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(question_id, int):
+        return None
+    return sort_key, question_id
+
+
+def get_limit(request):
+    limit = request.args.get('limit', QUESTIONS_PER_PAGE, type=int)
+    if limit < 1:
+        abort(400)
+    return min(limit, MAX_QUESTIONS_PER_PAGE)
+
+
+'''
+paginate_questions(request, category_id, sort_column)
+    returns a Page with the questions (of the category, if category_id is
+    given) requested in request.args, their total number and the cursor of
+    the next page (None on the last page). Only the rows of the page are
+    loaded: '?page=' is translated into LIMIT/OFFSET, while '?cursor=' and
+    '?after_id=' become keyset filters on (sort_column, Question.id).
+    '?limit=' sets the page size, capped at MAX_QUESTIONS_PER_PAGE.
+    The total comes from total_questions, without counting rows.
+'''
+
+
+def paginate_questions(request, category_id=None, sort_column=Question.id):
+    limit = get_limit(request)
+    page = request.args.get('page', 1, type=int)
+    after_id = request.args.get('after_id', None, type=int)
+    cursor = request.args.get('cursor', None)
+
+    sort_by_id = sort_column is Question.id
+    page_query = select_questions(Question.live())
+    if category_id is not None:
+        page_query = page_query.filter(Question.category == category_id)
+    if sort_by_id:
+        page_query = page_query.order_by(Question.id)
+    else:
+        page_query = page_query.order_by(sort_column, Question.id)
+
+    if cursor is not None:
+        position = decode_cursor(cursor)
+        if position is None:
+            abort(400)
+        sort_key, last_id = position
+        if sort_by_id:
+            page_query = page_query.filter(Question.id > last_id)
+        else:
+            page_query = page_query.filter(
+                tuple_(sort_column, Question.id) > tuple_(sort_key, last_id))
+    elif after_id is not None:
+        page_query = page_query.filter(Question.id > after_id)
+    elif page < 1:
+        return Page(QuestionRows(), total_questions(category_id), None)
+    else:
+        page_query = page_query.offset((page - 1) * limit)
+
+    # One extra row tells us whether there is a next page at all.
+    questions = fetch_rows(page_query.limit(limit + 1))
+    next_cursor = None
+    if len(questions) > limit:
+        questions = questions[:limit]
+        last = questions[-1]
+        next_cursor = encode_cursor(
+            getattr(last, sort_column.key), last.id)
+
+    return Page(QuestionRows(questions),
+                total_questions(category_id),
+                next_cursor)
+
+
+'''
+paginate_ids(request, ids, load_questions)
+    pages through an already ranked list of question ids, e.g. search
+    results. Cursors encode the (position, id) of the last question of the
+    page. load_questions(ids) loads the rows of the page's questions (as
+    selected by select_questions) and the page keeps the order of ids.
+'''
+
+
+def paginate_ids(request, ids, load_questions):
+    limit = get_limit(request)
+    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor', None)
+
+    if cursor is not None:
+        position = decode_cursor(cursor)
+        if position is None or not isinstance(position[0], int):
+            abort(400)
+        last_position, last_id = position
+        # The ranking may have changed since the cursor was handed out.
+        if not (0 <= last_position < len(ids) and
+                ids[last_position] == last_id) and last_id in ids:
+            last_position = ids.index(last_id)
+        start = max(last_position + 1, 0)
+    elif page < 1:
+        return Page(QuestionRows(), len(ids), None)
+    else:
+        start = (page - 1) * limit
+
+    page_ids = ids[start:start + limit]
+    next_cursor = None
+    if start + limit < len(ids):
+        next_cursor = encode_cursor(start + limit - 1, page_ids[-1])
+
+    questions = {}
+    if page_ids:
+        questions = {row.id: row for row in load_questions(page_ids)}
+    current_questions = QuestionRows(questions[question_id]
+                                     for question_id in page_ids
+                                     if question_id in questions)
+    return Page(current_questions, len(ids), next_cursor)
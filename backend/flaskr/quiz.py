@@ -0,0 +1,317 @@
+import random
+import threading
+import time
+
+from models import Question, on_question_write
+from .serializers import fetch_question, fetch_questions, fetch_rows
+
+ALL_CATEGORIES = 0
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 5
+QUIZ_INDEX_TTL = 300
+QUIZ_PICK_ATTEMPTS = 8
+QUIZ_BATCH_SIZE = 10
+QUIZ_BATCH_MAX = 50
+
+ADAPTIVE_WINDOW = 5
+ADAPTIVE_STEP_UP = 0.8
+ADAPTIVE_STEP_DOWN = 0.4
+
+
+'''
+QuizIndex
+    keeps the ids of all questions in memory, bucketed by category (bucket 0
+    holds every question) and by (category, difficulty) (where category 0
+    again means every category). Each bucket is a list plus an id ->
+    position map, so adding and removing ids is O(1) (swap with the last
+    element and pop). The index is loaded with one query on first use, kept
+    up to date by question writes in this process, and reloaded after ttl
+    seconds to pick up writes made by other processes.
+'''
+
+
+class QuizIndex:
+
+    def __init__(self, ttl=QUIZ_INDEX_TTL):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._buckets = None
+        self._questions = None
+        self._loaded_at = None
+
+    def _load(self):
+        self.load_rows(fetch_rows(Question.live().with_entities(
+            Question.id, Question.category, Question.difficulty
+        ).order_by(Question.id)))
+
+    def load_rows(self, rows):
+        '''
+        Fills the index from (id, category, difficulty) rows loaded
+        elsewhere, e.g. by the asyncio serving mode.
+        '''
+        buckets = {ALL_CATEGORIES: ([], {})}
+        questions = {}
+        for question_id, category, difficulty in rows:
+            questions[question_id] = (category, difficulty)
+            for key in bucket_keys(category, difficulty):
+                ids, positions = buckets.setdefault(key, ([], {}))
+                if question_id not in positions:
+                    positions[question_id] = len(ids)
+                    ids.append(question_id)
+
+        with self._lock:
+            self._buckets = buckets
+            self._questions = questions
+            self._loaded_at = time.monotonic()
+
+    def needs_load(self):
+        loaded_at = self._loaded_at
+        return (self._buckets is None or loaded_at is None or
+                time.monotonic() - loaded_at >= self.ttl)
+
+    def ensure_loaded(self):
+        if self.needs_load():
+            with self._lock:
+                if self.needs_load():
+                    self._load()
+
+    def _add_to_bucket(self, key, question_id):
+        ids, positions = self._buckets.setdefault(key, ([], {}))
+        if question_id not in positions:
+            positions[question_id] = len(ids)
+            ids.append(question_id)
+
+    def _remove_from_bucket(self, key, question_id):
+        ids, positions = self._buckets.get(key, ([], {}))
+        position = positions.pop(question_id, None)
+        if position is None:
+            return
+        last_id = ids.pop()
+        if last_id != question_id:
+            ids[position] = last_id
+            positions[last_id] = position
+
+    def add(self, question_id, category, difficulty):
+        with self._lock:
+            if self._buckets is None:
+                return
+            self.remove(question_id)
+            self._questions[question_id] = (category, difficulty)
+            for key in bucket_keys(category, difficulty):
+                self._add_to_bucket(key, question_id)
+
+    def remove(self, question_id):
+        with self._lock:
+            if self._buckets is None:
+                return
+            question = self._questions.pop(question_id, None)
+            if question is None:
+                return
+            for key in bucket_keys(*question):
+                self._remove_from_bucket(key, question_id)
+
+    def invalidate(self):
+        '''
+        Marks the index stale. Lookups keep reading the current buckets
+        until the next one reloads them, so a lookup that already checked
+        the index never finds it gone.
+        '''
+        with self._lock:
+            self._loaded_at = None
+
+    def contains(self, question_id):
+        '''
+        Returns whether the question is in the index, i.e. was not deleted
+        by this process since the index was loaded.
+        '''
+        with self._lock:
+            return (self._questions is not None and
+                    question_id in self._questions)
+
+    def sample_ids(self, category_id, count):
+        '''
+        Returns up to count distinct ids of the category in random order,
+        sampled without copying the bucket.
+        '''
+        self.ensure_loaded()
+        with self._lock:
+            ids = self._buckets.get(category_id, ([], {}))[0]
+            return random.sample(ids, min(count, len(ids)))
+
+    def pick_id(self, category_id, previous_questions, keys=None):
+        '''
+        Returns a random id from the category bucket, or from the union of
+        the buckets of keys if given, that is not in the previous_questions
+        set, or None if there is none left. Each draw picks a bucket with
+        probability proportional to its size and then an id in it, so ids
+        are drawn uniformly. A few random draws almost always succeed; only
+        when most of the buckets have been played already do we fall back
+        to scanning them.
+        '''
+        self.ensure_loaded()
+        if keys is None:
+            keys = [category_id]
+        with self._lock:
+            buckets = [self._buckets[key][0] for key in keys
+                       if key in self._buckets and self._buckets[key][0]]
+            total = sum(len(ids) for ids in buckets)
+            if not total:
+                return None
+            for _ in range(QUIZ_PICK_ATTEMPTS):
+                position = random.randrange(total)
+                for ids in buckets:
+                    if position < len(ids):
+                        break
+                    position -= len(ids)
+                question_id = ids[position]
+                if question_id not in previous_questions:
+                    return question_id
+            candidates = [question_id for ids in buckets
+                          for question_id in ids
+                          if question_id not in previous_questions]
+        if not candidates:
+            return None
+        return random.choice(candidates)
+
+    def pick_question(self, category_id, previous_questions, keys=None):
+        '''
+        Returns a random question of the category (or of the buckets of
+        keys) that is not in the previous_questions set, as a dict loaded
+        with a single primary key lookup, or None if there are no questions
+        left.
+        '''
+        while True:
+            question_id = self.pick_id(category_id, previous_questions, keys)
+            if question_id is None:
+                return None
+            question = fetch_question(question_id)
+            if question is not None:
+                return question
+            # Deleted by another process since the index was loaded.
+            self.remove(question_id)
+
+    def pick_ids(self, category_id, previous_questions, count):
+        '''
+        Returns up to count distinct random ids of the category that are not
+        in the previous_questions set, fewer if there are no more left.
+        '''
+        excluded = set(previous_questions)
+        ids = []
+        while len(ids) < count:
+            question_id = self.pick_id(category_id, excluded)
+            if question_id is None:
+                break
+            ids.append(question_id)
+            excluded.add(question_id)
+        return ids
+
+    def pick_questions(self, category_id, previous_questions, count):
+        '''
+        Returns up to count distinct random questions of the category that
+        are not in the previous_questions set, as dicts in random order,
+        loaded with a single primary key query rather than one query per
+        question.
+        '''
+        excluded = set(previous_questions)
+        questions = []
+        while len(questions) < count:
+            ids = self.pick_ids(category_id, excluded,
+                                count - len(questions))
+            if not ids:
+                break
+            excluded.update(ids)
+            loaded = fetch_questions(ids)
+            for question_id in ids:
+                if question_id in loaded:
+                    questions.append(loaded[question_id])
+                else:
+                    # Deleted by another process since the index was
+                    # loaded.
+                    self.remove(question_id)
+        return questions
+
+    def pick_adaptive_question(self, category_ids, low, high, target,
+                               previous_questions):
+        '''
+        Returns a random question of the categories with the target
+        difficulty, or else with the difficulty in [low, high] nearest to
+        it, that is not in the previous_questions set, or None. Only the
+        difficulties that have buckets in the categories are tried, nearest
+        to target first.
+        '''
+        self.ensure_loaded()
+        category_ids = set(key[0] for key in difficulty_keys(category_ids,
+                                                             [None]))
+        with self._lock:
+            difficulties = set(
+                key[1] for key in self._buckets
+                if isinstance(key, tuple) and key[0] in category_ids and
+                low <= key[1] <= high and self._buckets[key][0])
+        by_spread = {}
+        for difficulty in sorted(difficulties):
+            by_spread.setdefault(abs(difficulty - target), []).append(
+                difficulty)
+        for spread in sorted(by_spread):
+            question = self.pick_question(
+                None, previous_questions,
+                difficulty_keys(category_ids, by_spread[spread]))
+            if question is not None:
+                return question
+        return None
+
+
+def bucket_keys(category, difficulty):
+    return (ALL_CATEGORIES, category,
+            (ALL_CATEGORIES, difficulty), (category, difficulty))
+
+
+def difficulty_keys(category_ids, difficulties):
+    '''
+    Returns the keys of the (category, difficulty) buckets of the
+    categories and difficulties. The buckets are disjoint, unless the
+    categories include ALL_CATEGORIES, which then stands for all of them.
+    '''
+    if ALL_CATEGORIES in category_ids:
+        category_ids = [ALL_CATEGORIES]
+    return [(category_id, difficulty) for category_id in set(category_ids)
+            for difficulty in difficulties]
+
+
+'''
+Adaptive quizzes
+    target_difficulty(recent_answers, low, high) starts in the middle of the
+    [low, high] range and then follows the difficulty of the last answered
+    question: one level up if at least ADAPTIVE_STEP_UP of the last
+    ADAPTIVE_WINDOW answers were correct, one level down if at most
+    ADAPTIVE_STEP_DOWN were. QuizIndex.pick_adaptive_question then plays a
+    question of the target difficulty, or of the nearest difficulties in
+    the range that have questions left.
+'''
+
+
+def target_difficulty(recent_answers, low, high):
+    if not recent_answers:
+        return (low + high) // 2
+    window = recent_answers[-ADAPTIVE_WINDOW:]
+    level = window[-1][0]
+    accuracy = sum(1 for difficulty, correct in window if correct) / \
+        len(window)
+    if accuracy >= ADAPTIVE_STEP_UP:
+        level += 1
+    elif accuracy <= ADAPTIVE_STEP_DOWN:
+        level -= 1
+    return min(max(level, low), high)
+
+
+quiz_index = QuizIndex()
+
+
+@on_question_write
+def _update_quiz_index(action, question):
+    if action == 'reload':
+        quiz_index.invalidate()
+    elif action == 'delete':
+        quiz_index.remove(question['id'])
+    else:
+        quiz_index.add(question['id'], question['category'],
+                       question['difficulty'])
@@ -0,0 +1,218 @@
+import bisect
+import re
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import DDL, event, func
+
+from models import db, Question, on_question_write
+
+SEARCH_RESULT_LIMIT = 1000
+SEARCH_INDEX_TTL = 300
+QUESTION_WEIGHT = 2
+ANSWER_WEIGHT = 1
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+'''
+SearchBackend
+    interface of the search backends. search(term) returns the ids of the
+    questions whose question or answer contains a word starting with every
+    word of term, best matches first and at most SEARCH_RESULT_LIMIT of them.
+'''
+
+
+class SearchBackend:
+
+    def search(self, term, limit=SEARCH_RESULT_LIMIT):
+        raise NotImplementedError
+
+
+'''
+PostgresSearchBackend
+    full-text search with tsvector/tsquery and ts_rank. The search document
+    matches the expression of the questions_search_idx GIN index, so the
+    search never scans the whole table.
+'''
+
+SEARCH_CONFIG = 'english'
+SEARCH_INDEX_DDL = DDL(
+    "CREATE INDEX IF NOT EXISTS questions_search_idx ON questions "
+    "USING GIN (to_tsvector('english', "
+    "coalesce(question, '') || ' ' || coalesce(answer, '')))")
+
+event.listen(Question.__table__, 'after_create',
+             SEARCH_INDEX_DDL.execute_if(dialect='postgresql'))
+
+
+class PostgresSearchBackend(SearchBackend):
+
+    def search(self, term, limit=SEARCH_RESULT_LIMIT):
+        words = tokenize(term)
+        if not words:
+            return []
+
+        document = func.to_tsvector(
+            SEARCH_CONFIG,
+            func.coalesce(Question.question, '') + ' ' +
+            func.coalesce(Question.answer, ''))
+        query = func.to_tsquery(
+            SEARCH_CONFIG, ' & '.join(word + ':*' for word in words))
+        rows = Question.live().with_entities(Question.id).filter(
+            document.op('@@')(query)).order_by(
+            func.ts_rank(document, query).desc(), Question.id).limit(limit)
+        return [row[0] for row in rows]
+
+
+'''
+InvertedIndexSearchBackend
+    in-process inverted index for databases without full-text search, such
+    as SQLite in tests. Words are kept in a sorted list, so the postings of
+    all words with a given prefix are found with a binary search. Matches
+    are ranked by how often the words occur, with words in the question
+    counting more than words in the answer.
+'''
+
+
+class InvertedIndexSearchBackend(SearchBackend):
+
+    def __init__(self, ttl=SEARCH_INDEX_TTL):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._postings = None
+        self._words = None
+        self._documents = None
+        self._loaded_at = None
+
+    def _load(self):
+        # Searches wait for the lock while we build the index, and other
+        # threads must not take it for loaded before it is complete.
+        self._loaded_at = None
+        self._postings = defaultdict(dict)
+        self._documents = {}
+        rows = Question.live().with_entities(
+            Question.id, Question.question, Question.answer)
+        for question_id, question, answer in rows:
+            self._index(question_id, question, answer)
+        self._words = sorted(self._postings)
+        self._loaded_at = time.monotonic()
+
+    def _needs_load(self):
+        loaded_at = self._loaded_at
+        return (loaded_at is None or self._postings is None or
+                time.monotonic() - loaded_at >= self.ttl)
+
+    def _ensure_loaded(self):
+        if self._needs_load():
+            with self._lock:
+                if self._needs_load():
+                    self._load()
+
+    def _index(self, question_id, question, answer):
+        weights = defaultdict(int)
+        for word in tokenize(question):
+            weights[word] += QUESTION_WEIGHT
+        for word in tokenize(answer):
+            weights[word] += ANSWER_WEIGHT
+        new_words = [word for word in weights if word not in self._postings]
+        for word, weight in weights.items():
+            self._postings[word][question_id] = weight
+        self._documents[question_id] = list(weights)
+        return new_words
+
+    def _unindex(self, question_id):
+        removed_words = []
+        for word in self._documents.pop(question_id, []):
+            postings = self._postings.get(word)
+            if postings is None:
+                continue
+            postings.pop(question_id, None)
+            if not postings:
+                del self._postings[word]
+                removed_words.append(word)
+        return removed_words
+
+    def _remove_words(self, words):
+        for word in words:
+            position = bisect.bisect_left(self._words, word)
+            if position < len(self._words) and self._words[position] == word:
+                del self._words[position]
+
+    def add(self, question_id, question, answer):
+        with self._lock:
+            if self._postings is None:
+                return
+            self._remove_words(self._unindex(question_id))
+            for word in self._index(question_id, question, answer):
+                bisect.insort(self._words, word)
+
+    def remove(self, question_id):
+        with self._lock:
+            if self._postings is None:
+                return
+            self._remove_words(self._unindex(question_id))
+
+    def invalidate(self):
+        # Like QuizIndex.invalidate, only marks the index stale.
+        with self._lock:
+            self._loaded_at = None
+
+    def _prefix_scores(self, prefix):
+        scores = defaultdict(int)
+        position = bisect.bisect_left(self._words, prefix)
+        while (position < len(self._words) and
+               self._words[position].startswith(prefix)):
+            word = self._words[position]
+            for question_id, weight in self._postings[word].items():
+                scores[question_id] += weight
+            position += 1
+        return scores
+
+    def search(self, term, limit=SEARCH_RESULT_LIMIT):
+        words = tokenize(term)
+        if not words:
+            return []
+
+        self._ensure_loaded()
+        with self._lock:
+            scores = None
+            for word in words:
+                word_scores = self._prefix_scores(word)
+                if scores is None:
+                    scores = word_scores
+                else:
+                    scores = {question_id: score + word_scores[question_id]
+                              for question_id, score in scores.items()
+                              if question_id in word_scores}
+                if not scores:
+                    return []
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [question_id for question_id, score in ranked[:limit]]
+
+
+postgres_search = PostgresSearchBackend()
+inverted_index_search = InvertedIndexSearchBackend()
+
+
+def search_backend():
+    if db.engine.dialect.name == 'postgresql':
+        return postgres_search
+    return inverted_index_search
+
+
+@on_question_write
+def _update_search_index(action, question):
+    if action == 'reload':
+        inverted_index_search.invalidate()
+    elif action == 'delete':
+        inverted_index_search.remove(question['id'])
+    else:
+        inverted_index_search.add(
+            question['id'], question['question'], question['answer'])
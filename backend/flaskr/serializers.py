@@ -0,0 +1,169 @@
+import json
+from json.encoder import encode_basestring_ascii
+
+from flask import current_app
+from sqlalchemy import select
+
+from models import db, Question
+from .metrics import serialization_timer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+Question rows are selected as plain tuples of QUESTION_COLUMNS instead of
+ORM instances and encoded straight to JSON text with QUESTION_TEMPLATE, so
+listings don't build a dict per row before encoding. The encoded objects are
+the same as those of Question.format().
+'''
+
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer,
+                    Question.category, Question.difficulty)
+
+QUESTION_TEMPLATE = ('{"answer":%s,"category":%s,"difficulty":%s,'
+                     '"id":%s,"question":%s}')
+
+STREAM_CHUNK_ROWS = 1000
+
+
+class QuestionRows(list):
+    '''
+    List of question row tuples that json_response encodes as question
+    objects.
+    '''
+
+
+class EncodedJSON(str):
+    '''
+    JSON text encoded ahead of time, which json_response embeds as is.
+    '''
+
+
+def select_questions(query):
+    return query.with_entities(*QUESTION_COLUMNS)
+
+
+'''
+Read paths run their queries through fetch_rows and fetch_questions, which
+execute the SELECT statement on the Core level: rows come back as light
+tuple-like RowProxy objects, without the ORM's per-row loading,
+instrumentation and identity map (see benchmarks/bench_read_models.py).
+dict(row) gives the same dict as Question.format(). The ORM models remain
+the write path.
+'''
+
+
+def fetch_rows(query):
+    '''
+    Returns the rows of a select_questions (or other column) query.
+    '''
+    return db.session.execute(query.statement).fetchall()
+
+
+def fetch_questions(question_ids):
+    '''
+    Returns {id: question dict} for the questions of question_ids that
+    exist and are not deleted.
+    '''
+    return {row.id: dict(row) for row in db.session.execute(
+        select(QUESTION_COLUMNS).where(Question.id.in_(question_ids)).where(
+            Question.deleted_at.is_(None)))}
+
+
+def fetch_question(question_id):
+    '''
+    Returns the question as a dict, or None if it doesn't exist or is
+    deleted.
+    '''
+    row = db.session.execute(select(QUESTION_COLUMNS).where(
+        Question.id == question_id).where(
+        Question.deleted_at.is_(None))).first()
+    return dict(row) if row is not None else None
+
+
+def _encode_value(value):
+    if value is None:
+        return 'null'
+    if isinstance(value, str):
+        return encode_basestring_ascii(value)
+    return str(int(value))
+
+
+def encode_question(row):
+    question_id, question, answer, category, difficulty = row
+    return QUESTION_TEMPLATE % (
+        _encode_value(answer), _encode_value(category),
+        _encode_value(difficulty), _encode_value(question_id),
+        _encode_value(question))
+
+
+def encode_questions(rows):
+    return '[' + ','.join(encode_question(row) for row in rows) + ']'
+
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(
+            value, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+        ).decode('utf-8')
+    return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+
+'''
+encode_json(payload)
+    encodes a response body the way jsonify does, except that QuestionRows
+    values are encoded with the row template, EncodedJSON values are copied
+    and everything else is encoded with the fastest available JSON encoder
+    (orjson if installed, else the stdlib).
+    json_response(payload, status) wraps it in a Flask response.
+'''
+
+
+def encode_json(payload):
+    with serialization_timer():
+        members = []
+        for key in sorted(payload):
+            value = payload[key]
+            if isinstance(value, QuestionRows):
+                encoded = encode_questions(value)
+            elif isinstance(value, EncodedJSON):
+                encoded = value
+            else:
+                encoded = dumps(value)
+            members.append(encode_basestring_ascii(key) + ':' + encoded)
+        return '{' + ','.join(members) + '}'
+
+
+def json_response(payload, status=200):
+    return current_app.response_class(
+        encode_json(payload), status=status, mimetype='application/json')
+
+
+'''
+stream_questions(payload, rows)
+    generates a JSON object with the members of payload and a 'questions'
+    array encoded from the rows iterable, in chunks of STREAM_CHUNK_ROWS
+    rows, for responses too large to build in memory.
+'''
+
+
+def stream_questions(payload, rows):
+    head = dumps(payload)
+    if payload:
+        yield head[:-1] + ',"questions":['
+    else:
+        yield '{"questions":['
+
+    chunk = []
+    separator = ''
+    for row in rows:
+        chunk.append(encode_question(row))
+        if len(chunk) >= STREAM_CHUNK_ROWS:
+            yield separator + ','.join(chunk)
+            separator = ','
+            chunk = []
+    if chunk:
+        yield separator + ','.join(chunk)
+    yield ']}'
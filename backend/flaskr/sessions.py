@@ -0,0 +1,126 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from models import Question
+from .serializers import encode_question, fetch_rows, select_questions
+
+QUIZ_SESSION_TTL = 30 * 60
+QUIZ_SESSION_MAX_SESSIONS = 10000
+QUIZ_SESSION_QUESTIONS = 50
+QUIZ_SESSION_MAX_QUESTIONS = 200
+
+
+'''
+SessionStore
+    interface of the stores that keep quiz sessions between requests.
+    A session is the list of (id, JSON text) pairs of the questions still to
+    be played, in the order they will be played (the next question is the
+    last element). Stores that live outside the process only need to be
+    able to save and load such a list under a token.
+'''
+
+
+class SessionStore:
+
+    def get(self, token):
+        raise NotImplementedError
+
+    def set(self, token, questions):
+        raise NotImplementedError
+
+    def delete(self, token):
+        raise NotImplementedError
+
+
+'''
+MemorySessionStore
+    keeps sessions in process, evicting the least recently used session once
+    max_sessions is reached and dropping sessions that were not used for ttl
+    seconds.
+'''
+
+
+class MemorySessionStore(SessionStore):
+
+    def __init__(self, ttl=QUIZ_SESSION_TTL,
+                 max_sessions=QUIZ_SESSION_MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._sessions.get(token)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] >= self.ttl:
+                del self._sessions[token]
+                return None
+            return entry[0]
+
+    def set(self, token, questions):
+        with self._lock:
+            self._sessions[token] = (questions, time.monotonic())
+            self._sessions.move_to_end(token)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, token):
+        with self._lock:
+            self._sessions.pop(token, None)
+
+
+'''
+QuizSessions
+    starts quiz sessions with a pre-shuffled question order taken from the
+    quiz index and plays them one question at a time, so clients don't need
+    to send the questions they already played on every round. A session
+    holds max_questions questions (QUIZ_SESSION_QUESTIONS by default)
+    sampled from the category, so neither its cost nor its size grows with
+    the category. They are loaded with one query and encoded to JSON when
+    the session starts, so playing a round is a pop and no query; questions
+    this process deleted since are skipped.
+'''
+
+
+class QuizSessions:
+
+    def __init__(self, quiz_index, store=None):
+        self.quiz_index = quiz_index
+        self.store = store if store is not None else MemorySessionStore()
+
+    def start(self, category_id, max_questions=QUIZ_SESSION_QUESTIONS):
+        question_ids = self.quiz_index.sample_ids(category_id, max_questions)
+        rows = {row.id: row for row in fetch_rows(select_questions(
+            Question.live()).filter(Question.id.in_(question_ids)))}
+        questions = [(question_id, encode_question(rows[question_id]))
+                     for question_id in question_ids if question_id in rows]
+
+        token = secrets.token_urlsafe(16)
+        self.store.set(token, questions)
+        return token, len(questions)
+
+    def next_question(self, token):
+        '''
+        Returns (found, question): found is False for unknown or expired
+        tokens, and question is the question's JSON text, or None once the
+        session has been played.
+        '''
+        questions = self.store.get(token)
+        if questions is None:
+            return False, None
+
+        question = None
+        while question is None and questions:
+            question_id, encoded = questions.pop()
+            # Skip questions deleted since the session was started.
+            if self.quiz_index.contains(question_id):
+                question = encoded
+        self.store.set(token, questions)
+        return True, question
+
+    def end(self, token):
+        self.store.delete(token)
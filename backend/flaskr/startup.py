@@ -0,0 +1,51 @@
+import threading
+import time
+
+from .categories import category_cache
+from .metrics import metrics
+from .quiz import quiz_index
+from .suggest import suggest_index
+
+'''
+Startup
+
+create_app only configures the app: the database engine and its pool are
+created on first use, and the schema is only created by 'flask init-db'.
+WARM_UP (app config or environment) picks when the in-memory caches that
+most requests need are loaded:
+
+sync        in create_app, before the app serves requests (the default)
+background  in a thread, so the worker accepts requests right away and the
+            first of them load what isn't ready yet themselves
+off         on first use
+
+The seconds from the start of create_app to the end of each phase
+('create_app', 'warm_up', 'first_request') are reported as the
+trivia_startup_seconds gauge of GET /metrics.
+'''
+
+WARM_UP_MODES = ('sync', 'background', 'off')
+
+
+def warm_up(app, started):
+    '''
+    Loads the category cache, the quiz index and the suggest index.
+    '''
+    try:
+        with app.app_context():
+            category_cache.get()
+            quiz_index.ensure_loaded()
+            suggest_index.ensure_loaded()
+    except Exception:
+        # The caches load themselves when they are first used.
+        app.logger.exception('Warming up the caches failed')
+        return
+    metrics.record_startup('warm_up', time.perf_counter() - started)
+
+
+def start_warm_up(app, mode, started):
+    if mode == 'sync':
+        warm_up(app, started)
+    elif mode == 'background':
+        threading.Thread(target=warm_up, args=(app, started),
+                         name='warm-up', daemon=True).start()
@@ -0,0 +1,55 @@
+from sqlalchemy import func
+
+from models import db, QuestionCount
+
+
+'''
+Question statistics are read from the question_counts table, a handful of
+rows per category, so neither totals nor distributions scan the questions.
+'''
+
+
+def count_questions(category_id=None):
+    '''
+    Returns the number of questions, or of the questions of a category.
+    '''
+    query = db.session.query(func.coalesce(func.sum(QuestionCount.count), 0))
+    if category_id is not None:
+        query = query.filter(QuestionCount.category == category_id)
+    return int(query.scalar())
+
+
+def question_stats(categories):
+    '''
+    Returns the total number of questions, the number of questions per
+    difficulty, and per category of the {id: type} categories dict, with
+    the category's own distribution of difficulties. Questions without a
+    category are counted in 'uncategorized_questions'.
+    '''
+    stats = {
+        'total_questions': 0,
+        'uncategorized_questions': 0,
+        'difficulties': {},
+        'categories': {
+            category_id: {
+                'type': category_type,
+                'total_questions': 0,
+                'difficulties': {}
+            } for category_id, category_type in categories.items()
+        }
+    }
+
+    rows = QuestionCount.query.with_entities(
+        QuestionCount.category, QuestionCount.difficulty,
+        QuestionCount.count).filter(QuestionCount.count > 0)
+    for category_id, difficulty, count in rows:
+        stats['total_questions'] += count
+        stats['difficulties'][difficulty] = \
+            stats['difficulties'].get(difficulty, 0) + count
+        category = stats['categories'].get(category_id)
+        if category is None:
+            stats['uncategorized_questions'] += count
+            continue
+        category['total_questions'] += count
+        category['difficulties'][difficulty] = count
+    return stats
@@ -0,0 +1,222 @@
+import bisect
+import heapq
+import sys
+import threading
+import time
+
+from models import Question, on_question_write
+from .search import tokenize
+
+SNIPPET_LENGTH = 80
+SUGGEST_INDEX_MAX_BYTES = 64 * 1024 * 1024
+SUGGEST_INDEX_TTL = 300
+
+# Rough per-entry overheads: a list slot for a posting, and the dict entry
+# and int id of an indexed question or the dict entry, list and sorted
+# vocabulary slot of a word.
+POSTING_BYTES = 8
+QUESTION_BYTES = 100 + 28
+WORD_BYTES = 100 + 56 + 8
+
+
+'''
+SuggestIndex
+    word index over Question.question for search-as-you-type. Every word
+    maps to the sorted ids of the questions containing it, and a sorted list
+    of the words finds the words starting with a prefix by bisection. The
+    question texts are kept as well, so a suggestion never touches the
+    database.
+
+    A lookup merges the ids of the words starting with the rarest word of
+    the text, lowest first, and keeps the questions whose text has words
+    starting with the other words, until it has enough.
+
+    Creating, updating and deleting questions update the index in place.
+    Memory is bounded by max_bytes, which covers the texts, the words and
+    the postings: a question that would take the index over it is not
+    indexed (stats() then reports the index as incomplete). The index is
+    rebuilt after ttl seconds to pick up writes made by other processes.
+'''
+
+
+class SuggestIndex:
+
+    def __init__(self, max_bytes=SUGGEST_INDEX_MAX_BYTES,
+                 ttl=SUGGEST_INDEX_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._postings = None
+        self._words = None
+        self._questions = None
+        self._bytes = 0
+        self._skipped = 0
+        self._loaded_at = None
+
+    def _size(self, question, words):
+        size = QUESTION_BYTES + sys.getsizeof(question)
+        for word in words:
+            size += POSTING_BYTES
+            if word not in self._postings:
+                size += WORD_BYTES + sys.getsizeof(word)
+        return size
+
+    def _index(self, question_id, question, sort_words=True):
+        question = question or ''
+        words = set(tokenize(question))
+        size = self._size(question, words)
+        if self._bytes + size > self.max_bytes:
+            self._skipped += 1
+            return
+        self._questions[question_id] = question
+        self._bytes += size
+
+        for word in words:
+            ids = self._postings.get(word)
+            if ids is None:
+                ids = self._postings[word] = []
+                if sort_words:
+                    bisect.insort(self._words, word)
+                else:
+                    self._words.append(word)
+            if not ids or ids[-1] < question_id:
+                ids.append(question_id)
+            else:
+                bisect.insort(ids, question_id)
+
+    def _unindex(self, question_id):
+        question = self._questions.pop(question_id, None)
+        if question is None:
+            return
+        words = set(tokenize(question))
+
+        for word in words:
+            ids = self._postings[word]
+            del ids[bisect.bisect_left(ids, question_id)]
+            if not ids:
+                del self._postings[word]
+                del self._words[bisect.bisect_left(self._words, word)]
+        self._bytes -= self._size(question, words)
+
+    def load(self):
+        with self._lock:
+            self._postings = {}
+            self._words = []
+            self._questions = {}
+            self._bytes = 0
+            self._skipped = 0
+            rows = Question.live().with_entities(
+                Question.id, Question.question).order_by(Question.id)
+            for question_id, question in rows:
+                self._index(question_id, question, sort_words=False)
+            self._words.sort()
+            self._loaded_at = time.monotonic()
+
+    def _needs_load(self):
+        loaded_at = self._loaded_at
+        return (self._postings is None or loaded_at is None or
+                time.monotonic() - loaded_at >= self.ttl)
+
+    def ensure_loaded(self):
+        if self._needs_load():
+            with self._lock:
+                if self._needs_load():
+                    self.load()
+
+    def invalidate(self):
+        # Like QuizIndex.invalidate, only marks the index stale.
+        with self._lock:
+            self._loaded_at = None
+
+    def add(self, question_id, question):
+        with self._lock:
+            if self._postings is None:
+                return
+            self._unindex(question_id)
+            self._index(question_id, question)
+
+    def remove(self, question_id):
+        with self._lock:
+            if self._postings is None:
+                return
+            self._unindex(question_id)
+
+    def _words_starting_with(self, prefix):
+        start = bisect.bisect_left(self._words, prefix)
+        end = start
+        while (end < len(self._words) and
+               self._words[end].startswith(prefix)):
+            end += 1
+        return self._words[start:end]
+
+    def suggest(self, text, limit):
+        '''
+        Returns up to limit (id, snippet) pairs of questions containing words
+        starting with every word of text, lowest ids first.
+        '''
+        prefixes = set(tokenize(text))
+        if not prefixes:
+            return []
+
+        self.ensure_loaded()
+        with self._lock:
+            postings = {}
+            for prefix in prefixes:
+                postings[prefix] = [self._postings[word] for word in
+                                    self._words_starting_with(prefix)]
+                if not postings[prefix]:
+                    return []
+            rarest = min(prefixes, key=lambda prefix: sum(
+                len(ids) for ids in postings[prefix]))
+            others = prefixes - {rarest}
+
+            suggestions = []
+            previous_id = None
+            for question_id in heapq.merge(*postings[rarest]):
+                # A question with several words starting with the prefix
+                # comes up once per word.
+                if question_id == previous_id:
+                    continue
+                previous_id = question_id
+                question = self._questions[question_id]
+                words = tokenize(question)
+                if all(any(word.startswith(prefix) for word in words)
+                       for prefix in others):
+                    suggestions.append(
+                        (question_id, question[:SNIPPET_LENGTH]))
+                    if len(suggestions) >= limit:
+                        break
+            return suggestions
+
+    def stats(self):
+        with self._lock:
+            if self._postings is None:
+                return {
+                    'loaded': False,
+                    'complete': False,
+                    'questions': 0,
+                    'words': 0,
+                    'memory_bytes': 0,
+                    'max_memory_bytes': self.max_bytes
+                }
+            return {
+                'loaded': True,
+                'complete': not self._skipped,
+                'questions': len(self._questions),
+                'words': len(self._postings),
+                'memory_bytes': self._bytes,
+                'max_memory_bytes': self.max_bytes
+            }
+
+
+suggest_index = SuggestIndex()
+
+
+@on_question_write
+def _update_suggest_index(action, question):
+    if action == 'reload':
+        suggest_index.invalidate()
+    elif action == 'delete':
+        suggest_index.remove(question['id'])
+    else:
+        suggest_index.add(question['id'], question['question'])
@@ -1,25 +1,266 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import (Column, String, Integer, DateTime, ForeignKey, Index,
+                        create_engine, bindparam, event, exc, inspect, orm,
+                        select, text)
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
 database_name = "trivia"
-database_path = "postgres://{}/{}".format('localhost:5432', database_name)
+database_path = os.environ.get(
+    'DATABASE_URL',
+    "postgres://{}/{}".format('localhost:5432', database_name))
+
+'''
+Read replicas
+
+With DATABASE_REPLICA_URLS set, reads are spread over the replicas while
+writes go to the primary database:
+
+- a session sends its reads to one replica, picked round-robin when it
+  first reads;
+- once a session writes (flushes, or executes an INSERT, UPDATE, DELETE or
+  textual statement) it reads from the primary as well, so it sees its own
+  writes; use_primary() does the same up front;
+- for DB_READ_YOUR_WRITES seconds after a commit that wrote, new sessions of
+  the process read from the primary, so the requests right after a write
+  don't read from a replica that hasn't caught up yet;
+- a replica that can't be connected to is skipped for DB_REPLICA_RETRY
+  seconds and the session fails over to the next one, or to the primary
+  when none is left.
+
+Every app has a ReplicaSet of its own, app.extensions['replicas'].
+'''
+
+
+class ReplicaSet:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.engines = []
+        self.retry = 0
+        self.read_your_writes = 0
+        self._next = 0
+        self._down_until = {}
+        self._written_at = None
+
+    def configure(self, engines, retry, read_your_writes):
+        with self._lock:
+            for engine in self.engines:
+                engine.dispose()
+            self.engines = engines
+            self.retry = retry
+            self.read_your_writes = read_your_writes
+            self._next = 0
+            self._down_until = {}
+            self._written_at = None
+
+    def pick(self):
+        '''
+        Returns the next replica that isn't marked down, or None if reads
+        should go to the primary.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            if (self._written_at is not None and
+                    now - self._written_at < self.read_your_writes):
+                return None
+            for _ in range(len(self.engines)):
+                engine = self.engines[self._next % len(self.engines)]
+                self._next += 1
+                if self._down_until.get(engine, 0) <= now:
+                    return engine
+        return None
+
+    def mark_down(self, engine):
+        with self._lock:
+            self._down_until[engine] = time.monotonic() + self.retry
+
+    def note_write(self):
+        with self._lock:
+            self._written_at = time.monotonic()
+
+
+class RoutingSession(SignallingSession):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._replicas = self.app.extensions.get('replicas', ReplicaSet())
+        self._use_primary = False
+        self._wrote = False
+        self._replica = None
+
+    def use_primary(self):
+        '''
+        Sends the reads of the rest of the session to the primary.
+        '''
+        self._use_primary = True
+
+    def get_bind(self, mapper=None, clause=None):
+        primary = super().get_bind(mapper, clause)
+        # Explicit connection() calls and textual statements may write.
+        if (self._flushing or (mapper is None and clause is None) or
+                isinstance(clause, (UpdateBase, TextClause))):
+            self._use_primary = self._wrote = True
+        if self._use_primary or not self._replicas.engines:
+            return primary
+        if self._replica is None:
+            self._replica = self._replicas.pick()
+            if self._replica is None:
+                return primary
+        return self._replica
+
+    def _connection_for_bind(self, engine, execution_options=None, **kw):
+        try:
+            return super()._connection_for_bind(
+                engine, execution_options, **kw)
+        except exc.DBAPIError:
+            if self._replica is None or engine is not self._replica:
+                raise
+            self._replicas.mark_down(engine)
+            self._replica = self._replicas.pick()
+            return self._connection_for_bind(
+                self._replica or super().get_bind(), execution_options, **kw)
+
+    def commit(self):
+        super().commit()
+        if self._wrote:
+            self._wrote = False
+            self._replicas.note_write()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+'''
+Database settings, read from the app config or else from the environment:
+
+DB_POOL_SIZE            connections kept open per process
+DB_MAX_OVERFLOW         extra connections opened under load
+DB_POOL_PRE_PING        test connections before use (true/false)
+DB_POOL_RECYCLE         seconds after which connections are replaced
+DB_STATEMENT_TIMEOUT    PostgreSQL statement timeout in milliseconds, 0 = off
+DB_USE_NULLPOOL         open a connection per checkout and close it after,
+                        for running behind an external pooler like PgBouncer
+DATABASE_REPLICA_URLS   comma separated urls of read replicas
+DB_REPLICA_RETRY        seconds a replica that failed is skipped for
+DB_READ_YOUR_WRITES     seconds after a write during which reads go to the
+                        primary, 0 = off
+DB_COMPACTION_INTERVAL  seconds between purges of deleted questions by a
+                        background thread, 0 = off
+DB_TOMBSTONE_RETENTION  seconds deleted questions are kept before they are
+                        purged
+DB_COMPACTION_BATCH_SIZE  deleted questions purged per transaction
+'''
+DB_SETTINGS = {
+    'DB_POOL_SIZE': (int, 5),
+    'DB_MAX_OVERFLOW': (int, 10),
+    'DB_POOL_PRE_PING': (bool, True),
+    'DB_POOL_RECYCLE': (int, 1800),
+    'DB_STATEMENT_TIMEOUT': (int, 0),
+    'DB_USE_NULLPOOL': (bool, False),
+    'DATABASE_REPLICA_URLS': (str, ''),
+    'DB_REPLICA_RETRY': (int, 30),
+    'DB_READ_YOUR_WRITES': (float, 0),
+    'DB_COMPACTION_INTERVAL': (float, 600),
+    'DB_TOMBSTONE_RETENTION': (float, 3600),
+    'DB_COMPACTION_BATCH_SIZE': (int, 1000),
+}
+
+
+def setting(app, settings, name):
+    '''
+    Returns the setting name of the app config, or else of the environment,
+    converted to the type given for it in settings, or its default if unset.
+    '''
+    type, default = settings[name]
+    value = app.config.get(name, os.environ.get(name))
+    if value is None:
+        return default
+    if type is bool and isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return type(value)
+
+
+def db_setting(app, name):
+    return setting(app, DB_SETTINGS, name)
+
+
+def engine_options(app, database_path):
+    options = {'pool_pre_ping': db_setting(app, 'DB_POOL_PRE_PING')}
+    if db_setting(app, 'DB_USE_NULLPOOL'):
+        options['poolclass'] = NullPool
+    elif not database_path.startswith('sqlite'):
+        # SQLite uses its own pools, which don't take these options.
+        options['pool_size'] = db_setting(app, 'DB_POOL_SIZE')
+        options['max_overflow'] = db_setting(app, 'DB_MAX_OVERFLOW')
+        options['pool_recycle'] = db_setting(app, 'DB_POOL_RECYCLE')
+
+    statement_timeout = db_setting(app, 'DB_STATEMENT_TIMEOUT')
+    if statement_timeout and database_path.startswith('postgres'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(statement_timeout)
+        }
+    return options
 
-db = SQLAlchemy()
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, and connects the
+    read replicas if any are configured. The schema is only created with
+    create_tables=True (or 'flask init-db'), so serving processes don't
+    issue DDL when they start.
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, create_tables=False):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-    db.app = app
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        app, database_path)
     db.init_app(app)
-    db.create_all()
+    replica_urls = [url.strip() for url in
+                    db_setting(app, 'DATABASE_REPLICA_URLS').split(',')
+                    if url.strip()]
+    replicas = app.extensions['replicas'] = ReplicaSet()
+    replicas.configure(
+        [create_engine(url, **engine_options(app, url))
+         for url in replica_urls],
+        db_setting(app, 'DB_REPLICA_RETRY'),
+        db_setting(app, 'DB_READ_YOUR_WRITES'))
+    if create_tables:
+        db.create_all(app=app)
+
+
+'''
+on_question_write(listener)
+    registers listener(action, question) to be called after every committed
+    write to the questions table. action is 'insert', 'update' or 'delete'
+    and question is the formatted row as it was written. After bulk writes
+    action is 'reload' and question is None: anything derived from the
+    questions table has to be rebuilt.
+'''
+_question_write_listeners = []
+
+
+def on_question_write(listener):
+    _question_write_listeners.append(listener)
+    return listener
+
+
+def notify_question_write(action, question):
+    for listener in _question_write_listeners:
+        listener(action, question)
 
 
 '''
@@ -30,12 +271,26 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    # Serves both the category filter and the ordering by id of
+    # category listings, so a page is a single index range scan.
+    # The partial index on deleted_at only holds the tombstones, for
+    # compaction to find them.
+    __table_args__ = (
+        Index('questions_category_idx', 'category', 'id'),
+        Index('questions_deleted_at_idx', 'deleted_at',
+              postgresql_where=text('deleted_at IS NOT NULL'),
+              sqlite_where=text('deleted_at IS NOT NULL')),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(Integer)
+    category = Column(Integer, ForeignKey(
+        'categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
+    # Set when the question is deleted; the row stays as a tombstone until
+    # purge_deleted_questions removes it.
+    deleted_at = Column(DateTime)
 
     def __init__(self, question, answer, category, difficulty):
         self.question = question
@@ -43,16 +298,61 @@ class Question(db.Model):
         self.category = category
         self.difficulty = difficulty
 
+    '''
+    insert()
+        writes the question in a single transaction and returns it formatted.
+        The row is flushed to get its id and formatted before the commit, so
+        callers don't need to reload the expired instance afterwards.
+    '''
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        question = self.format()
+        adjust_question_counts({(self.category, self.difficulty): 1})
         db.session.commit()
+        notify_question_write('insert', question)
+        return question
 
     def update(self):
+        state = inspect(self)
+        category = state.attrs.category.history
+        difficulty = state.attrs.difficulty.history
+        if category.deleted or difficulty.deleted:
+            old_key = ((category.deleted or [self.category])[0],
+                       (difficulty.deleted or [self.difficulty])[0])
+            adjust_question_counts({
+                old_key: -1, (self.category, self.difficulty): 1})
         db.session.commit()
+        notify_question_write('update', self.format())
 
+    '''
+    delete()
+        soft-deletes the question with a single UPDATE: the row becomes a
+        tombstone that every read skips (see live()) and that compaction
+        purges later. The UPDATE only matches a live row, so of concurrent
+        deletes of the same question only one counts it out of
+        question_counts; the others return False.
+    '''
     def delete(self):
-        db.session.delete(self)
+        question = self.format()
+        questions = Question.__table__
+        result = db.session.execute(questions.update().where(
+            (questions.c.id == self.id) & questions.c.deleted_at.is_(None)
+        ).values(deleted_at=datetime.utcnow()))
+        if result.rowcount != 1:
+            db.session.rollback()
+            return False
+        adjust_question_counts({(self.category, self.difficulty): -1})
         db.session.commit()
+        notify_question_write('delete', question)
+        return True
+
+    @classmethod
+    def live(cls):
+        '''
+        Returns a query of the questions that are not deleted.
+        '''
+        return cls.query.filter(cls.deleted_at.is_(None))
 
     def format(self):
         return {
@@ -84,3 +384,104 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
         }
+
+
+'''
+QuestionCount
+    the number of questions per category and difficulty, kept up to date
+    in the same transaction as every write to the questions table, so
+    totals and distributions are read from a few rows instead of counting
+    the questions. Questions without a category or difficulty are counted
+    under 0.
+'''
+
+
+class QuestionCount(db.Model):
+    __tablename__ = 'question_counts'
+
+    category = Column(Integer, primary_key=True, autoincrement=False)
+    difficulty = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(Integer, nullable=False, default=0)
+
+
+# Supported by PostgreSQL 9.5+ and SQLite 3.24+.
+ADJUST_COUNT = text(
+    'INSERT INTO question_counts (category, difficulty, count) '
+    'VALUES (:category, :difficulty, :delta) '
+    'ON CONFLICT (category, difficulty) DO UPDATE '
+    'SET count = question_counts.count + excluded.count')
+
+RECOUNT_CATEGORIES = text(
+    'INSERT INTO question_counts (category, difficulty, count) '
+    'SELECT coalesce(category, 0), coalesce(difficulty, 0), count(*) '
+    'FROM questions WHERE coalesce(category, 0) IN :categories '
+    'AND deleted_at IS NULL '
+    'GROUP BY coalesce(category, 0), coalesce(difficulty, 0)'
+).bindparams(bindparam('categories', expanding=True))
+
+
+def adjust_question_counts(deltas, connection=None):
+    '''
+    Adds the {(category, difficulty): delta} deltas to question_counts in
+    the current transaction. Rows are updated in key order, so concurrent
+    transactions can't deadlock on them.
+    '''
+    params = [{'category': category or 0, 'difficulty': difficulty or 0,
+               'delta': delta}
+              for (category, difficulty), delta in deltas.items() if delta]
+    if params:
+        params.sort(key=lambda row: (row['category'], row['difficulty']))
+        (connection or db.session).execute(ADJUST_COUNT, params)
+
+
+def recount_categories(category_ids, connection=None):
+    '''
+    Recounts the questions of the categories (0 for no category) from the
+    questions table.
+    '''
+    executor = connection or db.session
+    executor.execute(QuestionCount.__table__.delete().where(
+        QuestionCount.category.in_(category_ids)))
+    executor.execute(RECOUNT_CATEGORIES, {'categories': list(category_ids)})
+
+
+def rebuild_question_counts():
+    '''
+    Recounts question_counts from scratch, e.g. after the questions table
+    was written to without the app.
+    '''
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('LOCK TABLE questions IN SHARE MODE')
+    db.session.execute(QuestionCount.__table__.delete())
+    db.session.execute(
+        'INSERT INTO question_counts (category, difficulty, count) '
+        'SELECT coalesce(category, 0), coalesce(difficulty, 0), count(*) '
+        'FROM questions WHERE deleted_at IS NULL '
+        'GROUP BY coalesce(category, 0), coalesce(difficulty, 0)')
+    db.session.commit()
+
+
+def purge_deleted_questions(deleted_before, batch_size):
+    '''
+    Removes the tombstones of questions deleted before the deleted_before
+    datetime, batch_size rows per transaction so no transaction holds many
+    row locks for long. Returns the number of rows removed.
+    '''
+    questions = Question.__table__
+    purged = 0
+    while True:
+        batch = select([questions.c.id]).where(
+            questions.c.deleted_at < deleted_before).limit(batch_size)
+        rowcount = db.session.execute(questions.delete().where(
+            questions.c.id.in_(batch))).rowcount
+        db.session.commit()
+        purged += rowcount
+        if rowcount < batch_size:
+            return purged
+
+
+# Deleting a category sets the category of its questions to NULL, which
+# moves them from the category's counts to those of category 0.
+@event.listens_for(Category, 'after_delete')
+def _recount_deleted_category(mapper, connection, target):
+    recount_categories([target.id, 0], connection)
@@ -1,23 +1,91 @@
 import os
+import sys
+import asyncio
+import tempfile
+import threading
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, event, exc
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.cache import RedisCache, ResponseCache
+from flaskr.categories import category_cache
+from flaskr.compaction import Compactor
+from flaskr.pagination import CountCache
+from flaskr.quiz import ALL_CATEGORIES, QUIZ_BATCH_MAX, QuizIndex, quiz_index
+from flaskr.search import InvertedIndexSearchBackend
+from flaskr.sessions import QUIZ_SESSION_MAX_QUESTIONS, QUIZ_SESSION_QUESTIONS
+from flaskr.stats import count_questions
+from flaskr.suggest import SuggestIndex
+from models import db, Question, Category
+
+
+class FakeRedis:
+    """Minimal in-memory stand-in for the redis-py client"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode('utf-8')
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+async def asgi_request(app, method, path, query='', json_body=None):
+    """Sends one request to an ASGI app, returns (status, headers, body)"""
+    body = json.dumps(json_body).encode('utf-8') if json_body else b''
+    headers = [(b'content-type', b'application/json'),
+               (b'content-length', str(len(body)).encode('ascii'))]
+    scope = {'type': 'http', 'http_version': '1.1', 'method': method,
+             'path': path, 'scheme': 'http', 'root_path': '',
+             'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+             'query_string': query.encode('ascii'), 'headers': headers}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return (messages[0]['status'], dict(messages[0]['headers']),
+            b''.join(message.get('body', b'') for message in messages[1:]))
 
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
+    @classmethod
+    def setUpClass(cls):
+        """Initialize the app and database once for all tests."""
+        # Rate limits would add up over the tests; they are tested with
+        # apps of their own.
+        cls.database_name = "trivia_test"
+        cls.database_path = "postgres://{}/{}".format(
+            'localhost:5432', cls.database_name)
+        cls.app = create_app(cls.app_config(
+            RATE_LIMITING=False, WARM_UP='off', DB_COMPACTION_INTERVAL=0))
+
+        # Create the tables and indexes trivia.psql doesn't have yet.
+        with cls.app.app_context():
+            db.create_all()
+
+    @classmethod
+    def app_config(cls, **config):
+        """Config of an app on the test database"""
+        config['SQLALCHEMY_DATABASE_URI'] = cls.database_path
+        return config
+
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
+        """Define test variables."""
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgres://{}/{}".format(
-            'localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
 
         self.new_question = {
             'question': 'What is the main capital of Germany?',
@@ -53,13 +121,6 @@ class TriviaTestCase(unittest.TestCase):
 
         self.play_quiz_question_possible_ids_category_2 = [18, 19]
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-
     def tearDown(self):
         """Executed after each test"""
         pass
@@ -114,6 +175,32 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['categories'])
         self.assertIsInstance(data['categories'], dict)
 
+    def test_200_get_categories_after_category_change(self):
+        res = self.client().get('/categories')
+        categories = json.loads(res.data)['categories']
+
+        with self.app.app_context():
+            category = Category('Music')
+            db.session.add(category)
+            db.session.commit()
+            category_id = category.id
+
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(len(data['categories']), len(categories) + 1)
+        self.assertEqual(data['categories'][str(category_id)], 'Music')
+
+        with self.app.app_context():
+            db.session.delete(Category.query.get(category_id))
+            db.session.commit()
+
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(data['categories'], categories)
+
     def test_200_get_questions(self):
         res = self.client().get('/questions')
         data = json.loads(res.data)
@@ -125,12 +212,195 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['categories'])
         self.assertIsInstance(data['categories'], dict)
 
+    def test_200_get_questions_match_question_format(self):
+        res = self.client().get('/questions?limit=100')
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        with self.app.app_context():
+            questions = [question.format() for question in
+                         Question.live().order_by(Question.id).limit(100)]
+        self.assertEqual(data['questions'], questions)
+
+    def test_200_export_questions_as_json(self):
+        res = self.client().get('/questions/export?format=json')
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(len(data['questions']),
+                         json.loads(self.client().get(
+                             '/questions').data)['total_questions'])
+
+    def test_304_get_questions_not_modified(self):
+        res = self.client().get('/questions')
+        etag = res.headers['ETag']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(etag)
+        self.assertIn('must-revalidate', res.headers['Cache-Control'])
+
+        res = self.client().get('/questions',
+                                headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        res = self.client().get('/categories/3/questions')
+        category_etag = res.headers['ETag']
+        res = self.client().get('/categories/3/questions',
+                                headers={'If-None-Match': category_etag})
+
+        self.assertEqual(res.status_code, 304)
+
+        res = self.client().post('/questions', json=self.new_question)
+        created_id = json.loads(res.data)['created_id']
+
+        res = self.client().get('/questions',
+                                headers={'If-None-Match': etag})
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+        res = self.client().get('/categories/3/questions',
+                                headers={'If-None-Match': category_etag})
+
+        self.assertEqual(res.status_code, 200)
+
+        self.client().delete('/questions/' + str(created_id))
+
+    def test_304_etags_shared_by_workers(self):
+        redis = FakeRedis()
+        workers = [create_app(self.app_config(
+            RESPONSE_CACHE_BACKEND=RedisCache(redis), WARM_UP='off'))
+            for _ in range(2)]
+
+        res = workers[0].test_client().get('/questions')
+        etag = res.headers['ETag']
+        res = workers[1].test_client().get('/questions',
+                                           headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+
+        # A write made by a worker of another process.
+        ResponseCache(RedisCache(redis)).invalidate('questions')
+        res = workers[1].test_client().get('/questions',
+                                           headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_200_get_questions_from_response_cache(self):
+        self.client().get('/questions?page=2')
+        res = self.client().get('/cache/stats')
+        stats = json.loads(res.data)['stats']
+
+        res = self.client().get('/questions?page=2')
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        res = self.client().get('/cache/stats')
+        self.assertEqual(json.loads(res.data)['stats']['hits'],
+                         stats['hits'] + 1)
+
+        res = self.client().post('/questions', json=self.new_question)
+        created_id = json.loads(res.data)['created_id']
+
+        res = self.client().get('/questions?page=2')
+        data = json.loads(res.data)
+
+        self.assertEqual(data['total_questions'],
+                         json.loads(self.client().get(
+                             '/questions').data)['total_questions'])
+        res = self.client().get('/cache/stats')
+        self.assertEqual(json.loads(res.data)['stats']['hits'],
+                         stats['hits'] + 1)
+
+        self.client().delete('/questions/' + str(created_id))
+
+    def test_200_search_from_shared_response_cache(self):
+        redis = FakeRedis()
+        app = create_app(self.app_config(
+            RESPONSE_CACHE_BACKEND=RedisCache(redis)))
+        client = app.test_client
+
+        res = client().post('/questions/search',
+                            json={'searchTerm': 'Soccer  World'})
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertTrue(redis.data)
+
+        res = client().post('/questions/search',
+                            json={'searchTerm': 'soccer world'})
+
+        self.assertEqual(json.loads(res.data), data)
+        res = client().get('/cache/stats')
+        stats = json.loads(res.data)['stats']
+        self.assertEqual(stats['backend'], 'RedisCache')
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
     def test_404_get_questions_beyond_valid_page(self):
         res = self.client().get('/questions?page=1000')
         data = json.loads(res.data)
 
         self.check_404(res, data)
 
+    def test_200_get_questions_after_id(self):
+        res = self.client().get('/questions')
+        first_page = json.loads(res.data)
+        last_id = first_page['questions'][-1]['id']
+
+        res = self.client().get('/questions?after_id=' + str(last_id))
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertTrue(data['questions'])
+        self.assertTrue(all(question['id'] > last_id
+                            for question in data['questions']))
+        self.assertEqual(data['total_questions'],
+                         first_page['total_questions'])
+
+        res = self.client().get('/questions?page=2')
+        second_page = json.loads(res.data)
+        self.assertEqual(data['questions'], second_page['questions'])
+
+    def test_200_get_questions_with_cursor(self):
+        res = self.client().get('/questions?limit=5')
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(len(data['questions']), 5)
+        self.assertTrue(data['next_cursor'])
+
+        seen_ids = [question['id'] for question in data['questions']]
+        while data['next_cursor']:
+            res = self.client().get(
+                '/questions?limit=5&cursor=' + data['next_cursor'])
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            seen_ids += [question['id'] for question in data['questions']]
+
+        self.assertEqual(seen_ids, sorted(set(seen_ids)))
+        self.assertEqual(len(seen_ids), data['total_questions'])
+
+    def test_400_get_questions_invalid_cursor_or_limit(self):
+        res = self.client().get('/questions?cursor=not-a-cursor')
+        data = json.loads(res.data)
+
+        self.check_400(res, data)
+
+        res = self.client().get('/questions?limit=0')
+        data = json.loads(res.data)
+
+        self.check_400(res, data)
+
+    def test_404_get_questions_invalid_page(self):
+        res = self.client().get('/questions?page=0')
+        data = json.loads(res.data)
+
+        self.check_404(res, data)
+
     def test_200_get_questions_by_category(self):
         res = self.client().get('/categories/1/questions')
         data = json.loads(res.data)
@@ -141,6 +411,16 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['current_category'])
         self.assertEqual(data['current_category'], 1)
 
+    def test_200_get_questions_by_category_only_returns_category(self):
+        res = self.client().get('/categories/2/questions')
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual([question['id'] for question in data['questions']],
+                         [16, 17, 18, 19])
+        self.assertEqual(data['total_questions'], 4)
+        self.assertEqual(data['next_cursor'], None)
+
     def test_404_get_questions_invalid_category_id(self):
         res = self.client().get('/categories/1000/questions')
         data = json.loads(res.data)
@@ -181,7 +461,8 @@ class TriviaTestCase(unittest.TestCase):
 
     def test_200_create_and_delete_question(self):
         # Create a question, test if it works properly
-        res = self.client().post('/questions', json=self.new_question)
+        res = self.client().post('/questions?include=questions',
+                                 json=self.new_question)
         data = json.loads(res.data)
 
         self.check_200(res, data)
@@ -196,11 +477,13 @@ class TriviaTestCase(unittest.TestCase):
         created_id = data['created_id']
 
         # Test if deleting a question works properly
-        res = self.client().delete('/questions/' + str(created_id))
+        res = self.client().delete(
+            '/questions/' + str(created_id) + '?include=questions')
         data = json.loads(res.data)
 
-        question = Question.query.filter(
-            Question.id == created_id).one_or_none()
+        with self.app.app_context():
+            question = Question.live().filter(
+                Question.id == created_id).one_or_none()
 
         self.check_200(res, data)
         self.assertEqual(question, None)
@@ -209,6 +492,154 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(data['categories'])
 
+    def test_200_create_and_delete_question_lean_response(self):
+        res = self.client().get('/questions')
+        total_questions = json.loads(res.data)['total_questions']
+
+        res = self.client().post('/questions', json=self.new_question)
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertTrue(data['created_id'])
+        self.assertEqual(data['total_questions'], total_questions + 1)
+        self.assertNotIn('questions', data)
+        self.assertNotIn('categories', data)
+
+        created_id = data['created_id']
+        res = self.client().get('/categories/3/questions?limit=100')
+        data = json.loads(res.data)
+
+        self.assertEqual(data['total_questions'], len(data['questions']))
+        self.assertIn(created_id,
+                      [question['id'] for question in data['questions']])
+
+        res = self.client().delete('/questions/' + str(created_id))
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['deleted_id'], created_id)
+        self.assertEqual(data['total_questions'], total_questions)
+        self.assertNotIn('questions', data)
+
+    def test_200_deleted_question_is_a_tombstone_skipped_by_reads(self):
+        res = self.client().post('/questions', json=self.new_question)
+        created_id = json.loads(res.data)['created_id']
+        quiz = {
+            'previous_questions': [],
+            'quiz_category': {'type': 'Geography', 'id': 3}
+        }
+        self.client().post('/quizzes/batch', json=dict(quiz, count=50))
+
+        res = self.client().delete('/questions/' + str(created_id))
+        self.assertEqual(res.status_code, 200)
+
+        with self.app.app_context():
+            self.assertTrue(Question.query.get(created_id).deleted_at)
+        res = self.client().get('/categories/3/questions?limit=100')
+        data = json.loads(res.data)
+        self.assertEqual(data['total_questions'], len(data['questions']))
+        self.assertNotIn(created_id,
+                         [question['id'] for question in data['questions']])
+        res = self.client().post('/questions/search',
+                                 json={'searchTerm': 'capital of Germany'})
+        self.assertEqual(json.loads(res.data)['total_questions'], 0)
+        res = self.client().post('/quizzes/batch', json=dict(quiz, count=50))
+        self.assertNotIn(created_id, [question['id'] for question in
+                                      json.loads(res.data)['questions']])
+        res = self.client().get('/questions/export')
+        self.assertNotIn(created_id, [json.loads(line)['id'] for line in
+                                      res.data.decode('utf-8').splitlines()])
+
+        res = self.client().delete('/questions/' + str(created_id))
+        self.assertEqual(res.status_code, 422)
+
+    def test_concurrent_deletes_count_a_question_out_once(self):
+        res = self.client().post('/questions', json=self.new_question)
+        created_id = json.loads(res.data)['created_id']
+
+        with self.app.app_context():
+            # Two requests that both loaded the question before either
+            # deleted it.
+            first = Question.live().filter(
+                Question.id == created_id).one()
+            db.session.expunge(first)
+            second = Question.live().filter(
+                Question.id == created_id).one()
+
+            self.assertTrue(second.delete())
+            self.assertFalse(first.delete())
+            self.assertEqual(count_questions(), Question.live().count())
+
+    def test_compaction_purges_old_tombstones(self):
+        ids = []
+        for _ in range(2):
+            res = self.client().post('/questions', json=self.new_question)
+            ids.append(json.loads(res.data)['created_id'])
+            self.client().delete('/questions/' + str(ids[-1]))
+        with self.app.app_context():
+            Question.query.get(ids[0]).deleted_at = \
+                datetime.utcnow() - timedelta(hours=2)
+            db.session.commit()
+
+        compactor = Compactor(self.app, 0, 3600, 1)
+        self.assertTrue(compactor.run_once() >= 1)
+
+        with self.app.app_context():
+            self.assertEqual(Question.query.get(ids[0]), None)
+            self.assertTrue(Question.query.get(ids[1]).deleted_at)
+
+    def test_200_bulk_import_and_export_questions(self):
+        rows = [
+            {'question': 'Bulk question one?', 'answer': 'One',
+             'difficulty': 1, 'category': 1},
+            {'question': 'Bulk question two?', 'answer': '',
+             'difficulty': 1, 'category': 1},
+            {'question': 'Bulk question three?', 'answer': 'Three',
+             'difficulty': 'hard', 'category': 1}
+        ]
+        body = '\n'.join(json.dumps(row) for row in rows) + '\n{oops\n'
+        res = self.client().post('/questions/bulk', data=body,
+                                 content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['failed'], 3)
+        self.assertEqual([error['line'] for error in data['errors']],
+                         [2, 3, 4])
+
+        body = ('question,answer,difficulty,category\n'
+                'Bulk question four?,Four,2,3\n'
+                'Bulk question five?,Five,2,1000\n')
+        res = self.client().post('/questions/bulk', data=body,
+                                 content_type='text/csv')
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['errors'],
+                         [{'line': 3, 'error': 'category does not exist'}])
+
+        res = self.client().get('/questions/export')
+        exported = [json.loads(line)
+                    for line in res.data.decode('utf-8').splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([row['id'] for row in exported],
+                         sorted(row['id'] for row in exported))
+        created_ids = [row['id'] for row in exported
+                       if row['question'].startswith('Bulk question')]
+        self.assertEqual(len(created_ids), 2)
+
+        res = self.client().get('/questions/export?format=csv')
+        lines = res.data.decode('utf-8').splitlines()
+
+        self.assertEqual(lines[0], 'id,question,answer,difficulty,category')
+        self.assertEqual(len(lines), len(exported) + 1)
+
+        for created_id in created_ids:
+            self.client().delete('/questions/' + str(created_id))
+
     def test_422_delete_question_does_not_exist(self):
         res = self.client().delete('/questions/1000')
         data = json.loads(res.data)
@@ -235,6 +666,217 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(int(data['current_category']), 0)
         self.assertEqual(len(data['questions']), 1)
 
+    def test_200_search_for_question_by_answer_and_prefix(self):
+        res = self.client().post('/questions/search',
+                                 json={'searchTerm': 'Fleming'})
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual([question['id'] for question in data['questions']],
+                         [21])
+
+        res = self.client().post('/questions/search',
+                                 json={'searchTerm': 'soccer world'})
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['total_questions'], 2)
+        self.assertEqual(
+            sorted(question['id'] for question in data['questions']),
+            [10, 11])
+
+        res = self.client().post('/questions/search',
+                                 json={'searchTerm': 'penicil'})
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['questions'][0]['id'], 21)
+
+    def test_200_suggest_questions(self):
+        res = self.client().get('/questions/suggest?q=socc')
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(
+            [suggestion['id'] for suggestion in data['suggestions']],
+            [10, 11])
+
+        res = self.client().get('/questions/suggest?q=first%20soc&limit=1')
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(
+            [suggestion['id'] for suggestion in data['suggestions']], [11])
+
+    def test_200_suggest_questions_sees_created_question(self):
+        res = self.client().post('/questions', json=self.new_question)
+        created_id = json.loads(res.data)['created_id']
+
+        res = self.client().get('/questions/suggest?q=germ')
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertIn(created_id, [suggestion['id']
+                                   for suggestion in data['suggestions']])
+
+        self.client().delete('/questions/' + str(created_id))
+
+        res = self.client().get('/questions/suggest?q=germ')
+        data = json.loads(res.data)
+
+        self.assertNotIn(created_id, [suggestion['id']
+                                      for suggestion in data['suggestions']])
+
+    def test_400_suggest_questions_without_text(self):
+        res = self.client().get('/questions/suggest?q=')
+        data = json.loads(res.data)
+
+        self.check_400(res, data)
+
+    def test_suggest_multiple_words_beyond_common_prefixes(self):
+        index = SuggestIndex()
+        with self.app.app_context():
+            index.load()
+        for question_id in range(1000, 1030):
+            index.add(question_id, 'What is the capital of country %d?'
+                      % question_id)
+        index.add(1030, 'What is the capital of the zebra republic?')
+
+        self.assertEqual(index.suggest('zebra capital', 10), [
+            (1030, 'What is the capital of the zebra republic?')])
+        self.assertEqual([question_id for question_id, snippet in
+                          index.suggest('capital coun', 3)],
+                         [1000, 1001, 1002])
+
+        index.remove(1000)
+        self.assertEqual([question_id for question_id, snippet in
+                          index.suggest('capital coun', 3)],
+                         [1001, 1002, 1003])
+
+    def test_count_cache_is_thread_safe(self):
+        cache = CountCache(max_entries=4)
+        errors = []
+        done = threading.Event()
+
+        def use_cache():
+            try:
+                for i in range(5000):
+                    key = 'category:%d' % (i % 8)
+                    cache.store(key, i)
+                    cache.lookup(key)
+                    cache.adjust(key, 1)
+            except Exception as error:
+                errors.append(error)
+
+        def clear_cache():
+            # Like question updates and reloads do.
+            while not done.is_set():
+                cache.clear()
+
+        # Switch threads as often as possible to hit the races.
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+        clearer = threading.Thread(target=clear_cache)
+        clearer.start()
+        threads = [threading.Thread(target=use_cache) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        clearer.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(cache.lookup('category:9'), None)
+
+    def test_lookups_survive_a_reload_after_their_load_check(self):
+        quiz = QuizIndex()
+        suggest = SuggestIndex()
+        search = InvertedIndexSearchBackend()
+
+        def reload_after(check, index):
+            # A bulk import lands between the check and the lookup.
+            def checked():
+                check()
+                index.invalidate()
+            return checked
+
+        with self.app.app_context():
+            for index in (quiz, suggest):
+                index.ensure_loaded = reload_after(index.ensure_loaded, index)
+            search._ensure_loaded = reload_after(search._ensure_loaded, search)
+
+            self.assertTrue(quiz.pick_id(ALL_CATEGORIES, set()))
+            self.assertEqual(len(quiz.sample_ids(ALL_CATEGORIES, 3)), 3)
+            self.assertTrue(quiz.pick_adaptive_question(
+                [ALL_CATEGORIES], 1, 5, 3, set()))
+            self.assertTrue(suggest.suggest('socc', 10))
+            self.assertTrue(search.search('soccer'))
+
+    def test_suggest_index_memory_is_bounded(self):
+        index = SuggestIndex(max_bytes=2000)
+        with self.app.app_context():
+            index.load()
+        stats = index.stats()
+
+        self.assertTrue(stats['questions'])
+        self.assertFalse(stats['complete'])
+        self.assertTrue(stats['memory_bytes'] <= 2000)
+
+    def test_200_get_suggest_stats(self):
+        # Suggestions load the index if the app was not warmed up.
+        self.client().get('/questions/suggest?q=box')
+        res = self.client().get('/questions/suggest/stats')
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertTrue(data['stats']['questions'])
+        self.assertTrue(data['stats']['memory_bytes'] <=
+                        data['stats']['max_memory_bytes'])
+
+    def test_429_search_rate_limited_per_client(self):
+        client = create_app(self.app_config(
+            RATE_LIMITS={'search_for_question': (0.01, 2)})).test_client()
+
+        for _ in range(2):
+            res = client.post('/questions/search', json=self.searchTerm)
+            self.assertEqual(res.status_code, 200)
+
+        res = client.post('/questions/search', json=self.searchTerm)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'too many requests')
+        self.assertTrue(int(res.headers['Retry-After']) > 0)
+
+        # Other clients and endpoints have their own buckets.
+        res = client.post('/questions/search', json=self.searchTerm,
+                          environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(res.status_code, 200)
+        res = client.post('/quizzes', json=self.play_quiz_json_category_1)
+        self.assertEqual(res.status_code, 200)
+
+    def test_503_quiz_sheds_load_when_saturated(self):
+        app = create_app(self.app_config(ADMISSION_MAX_CONCURRENT=1,
+                                         ADMISSION_TIMEOUT=0.01))
+        limiter = app.extensions['concurrency_limiter']
+
+        self.assertTrue(limiter.acquire())
+        res = app.test_client().post('/quizzes',
+                                     json=self.play_quiz_json_category_1)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['message'], 'service unavailable')
+        self.assertEqual(res.headers['Retry-After'], '1')
+
+        limiter.release()
+        for _ in range(2):
+            res = app.test_client().post('/quizzes',
+                                         json=self.play_quiz_json_category_1)
+            self.assertEqual(res.status_code, 200)
+
     def test_200_play_quiz(self):
         # Test with all categories
         res = self.client().post('/quizzes',
@@ -265,6 +907,532 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['question']['id'] in
                         self.play_quiz_question_possible_ids_category_2)
 
+    def test_200_play_quiz_sees_created_and_deleted_questions(self):
+        res = self.client().get('/categories/3/questions?limit=100')
+        previous_questions = [question['id'] for question in
+                              json.loads(res.data)['questions']]
+        quiz = {
+            'previous_questions': previous_questions,
+            'quiz_category': {'type': 'Geography', 'id': 3}
+        }
+
+        res = self.client().post('/quizzes', json=quiz)
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['question'], None)
+
+        res = self.client().post('/questions', json=self.new_question)
+        created_id = json.loads(res.data)['created_id']
+
+        res = self.client().post('/quizzes', json=quiz)
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['question']['id'], created_id)
+
+        self.client().delete('/questions/' + str(created_id))
+
+        res = self.client().post('/quizzes', json=quiz)
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['question'], None)
+
+    def test_400_play_quiz_invalid_category(self):
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'Art', 'id': 'art'}
+        })
+        data = json.loads(res.data)
+
+        self.check_400(res, data)
+
+    def test_200_play_quiz_batch(self):
+        res = self.client().post('/quizzes/batch', json=dict(
+            self.play_quiz_json_category_2, count=5))
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(
+            sorted(question['id'] for question in data['questions']),
+            self.play_quiz_question_possible_ids_category_2)
+
+        res = self.client().post('/quizzes/batch', json=dict(
+            self.play_quiz_json_category_all, count=10))
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        ids = [question['id'] for question in data['questions']]
+        self.assertEqual(len(ids), 10)
+        self.assertEqual(len(set(ids)), 10)
+
+        res = self.client().post('/quizzes/batch', json=dict(
+            self.play_quiz_json_category_1, previous_questions=[20, 21, 22]))
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['questions'], [])
+
+    def test_400_play_quiz_batch_invalid_count(self):
+        for count in (0, QUIZ_BATCH_MAX + 1, '5', True):
+            res = self.client().post('/quizzes/batch', json=dict(
+                self.play_quiz_json_category_1, count=count))
+            data = json.loads(res.data)
+
+            self.check_400(res, data)
+
+    def test_quiz_reads_questions_without_orm_instances(self):
+        with self.app.app_context():
+            question = quiz_index.pick_question(
+                1, set(self.play_quiz_json_category_1['previous_questions']))
+
+            self.assertEqual(len(db.session.identity_map), 0)
+            self.assertEqual(question, Question.query.get(
+                self.play_quiz_question_id_category_1).format())
+
+    def play_adaptive_quiz(self, body):
+        played = []
+        while True:
+            body['previous_questions'] = [
+                question['id'] for question in played]
+            res = self.client().post('/quizzes/adaptive', json=body)
+            data = json.loads(res.data)
+            self.check_200(res, data)
+            if data['question'] is None:
+                return played
+            played.append(data['question'])
+
+    def test_200_play_adaptive_quiz_in_categories_and_difficulties(self):
+        played = self.play_adaptive_quiz({
+            'quiz_categories': [1, 2],
+            'difficulty': {'min': 3, 'max': 4}
+        })
+
+        self.assertEqual(len(played), 5)
+        self.assertEqual(len(set(question['id'] for question in played)), 5)
+        for question in played:
+            self.assertIn(question['category'], [1, 2])
+            self.assertIn(question['difficulty'], [3, 4])
+
+    def test_200_play_adaptive_quiz_adapts_difficulty(self):
+        res = self.client().post('/quizzes/adaptive', json={
+            'previous_questions': [],
+            'recent_answers': [{'difficulty': 2, 'correct': True}] * 5
+        })
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['target_difficulty'], 3)
+        self.assertEqual(data['question']['difficulty'], 3)
+
+        res = self.client().post('/quizzes/adaptive', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'Art', 'id': 2},
+            'recent_answers': [{'difficulty': 2, 'correct': False}] * 5
+        })
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['target_difficulty'], 1)
+        self.assertEqual(data['question']['id'], 16)
+
+    def test_200_adaptive_quiz_falls_back_to_nearest_difficulty(self):
+        res = self.client().post('/quizzes/adaptive', json={
+            'previous_questions': [],
+            'quiz_categories': [1],
+            'recent_answers': [{'difficulty': 1, 'correct': False}]
+        })
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['target_difficulty'], 1)
+        self.assertEqual(data['question']['difficulty'], 3)
+
+    def test_400_adaptive_quiz_invalid_difficulty_range(self):
+        res = self.client().post('/quizzes/adaptive', json={
+            'previous_questions': [],
+            'difficulty': {'min': 4, 'max': 2}
+        })
+        data = json.loads(res.data)
+
+        self.check_400(res, data)
+
+    def test_400_adaptive_quiz_difficulty_out_of_range(self):
+        res = self.client().post('/quizzes/adaptive', json={
+            'previous_questions': [],
+            'difficulty': {'min': 1, 'max': 2000000}
+        })
+        data = json.loads(res.data)
+
+        self.check_400(res, data)
+
+    def test_200_play_quiz_session(self):
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'Art', 'id': 2}
+        })
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertTrue(data['session_token'])
+        self.assertEqual(data['total_questions'], 4)
+
+        next_url = '/quizzes/sessions/' + data['session_token'] + '/next'
+        played_ids = []
+        for _ in range(4):
+            res = self.client().post(next_url)
+            data = json.loads(res.data)
+            self.check_200(res, data)
+            self.assertEqual(data['question']['category'], 2)
+            played_ids.append(data['question']['id'])
+
+        self.assertEqual(sorted(played_ids), [16, 17, 18, 19])
+
+        res = self.client().post(next_url)
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['question'], None)
+
+    def test_quiz_session_rounds_run_no_queries(self):
+        res = self.client().post('/questions', json=self.new_question)
+        created_id = json.loads(res.data)['created_id']
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'Geography', 'id': 3}
+        })
+        data = json.loads(res.data)
+        total_questions = data['total_questions']
+        next_url = '/quizzes/sessions/' + data['session_token'] + '/next'
+        self.client().delete('/questions/' + str(created_id))
+
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', count_statement)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute',
+                        count_statement)
+        played_ids = []
+        for _ in range(total_questions):
+            res = self.client().post(next_url)
+            question = json.loads(res.data)['question']
+            if question is not None:
+                played_ids.append(question['id'])
+
+        self.assertEqual(statements, [])
+        self.assertEqual(len(played_ids), total_questions - 1)
+        self.assertNotIn(created_id, played_ids)
+
+    def test_404_play_quiz_session_unknown_token(self):
+        res = self.client().post('/quizzes/sessions/unknown/next')
+        data = json.loads(res.data)
+
+        self.check_404(res, data)
+
+    def test_400_start_quiz_session_invalid_body(self):
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'Art', 'id': 2},
+            'max_questions': 0
+        })
+        data = json.loads(res.data)
+
+        self.check_400(res, data)
+
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'Art', 'id': 2},
+            'max_questions': QUIZ_SESSION_MAX_QUESTIONS + 1
+        })
+        data = json.loads(res.data)
+
+        self.check_400(res, data)
+
+    def test_quiz_session_samples_a_quiz_sized_order(self):
+        with self.app.app_context():
+            total = len(quiz_index.sample_ids(0, 1000))
+            question_ids = quiz_index.sample_ids(0, 5)
+
+        self.assertEqual(len(question_ids), 5)
+        self.assertEqual(len(set(question_ids)), 5)
+
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'All', 'id': 0}
+        })
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['total_questions'],
+                         min(total, QUIZ_SESSION_QUESTIONS))
+
+    def create_asgi_app(self, **config):
+        """Creates the async app, or skips without requirements-async.txt"""
+        try:
+            from flaskr.asgi import create_asgi_app
+        except ImportError:
+            self.skipTest('the async serving mode is not installed')
+        return create_asgi_app(self.app_config(**config))
+
+    def test_200_async_mode_matches_flask_responses(self):
+        asgi_app = self.create_asgi_app()
+        requests = [
+            ('GET', '/categories', ''),
+            ('GET', '/questions', 'page=2'),
+            ('GET', '/questions', 'limit=3&after_id=5'),
+            ('GET', '/questions', 'page=1000'),
+            ('GET', '/questions', 'limit=0'),
+            ('GET', '/categories/2/questions', ''),
+            ('GET', '/categories/1000/questions', ''),
+        ]
+
+        async def run():
+            try:
+                return [await asgi_request(asgi_app, method, path, query)
+                        for method, path, query in requests]
+            finally:
+                await asgi_app.database.close()
+
+        for (method, path, query), (status, headers, body) in zip(
+                requests, asyncio.run(run())):
+            res = self.client().open(path, method=method,
+                                     query_string=query)
+            self.assertEqual(status, res.status_code)
+            self.assertEqual(json.loads(body), json.loads(res.data))
+            self.assertEqual(headers[b'access-control-allow-origin'], b'*')
+
+    def test_200_async_mode_play_quiz_and_delegated_routes(self):
+        asgi_app = self.create_asgi_app()
+        quiz_json = self.play_quiz_json_category_1
+
+        async def run():
+            try:
+                return (
+                    await asgi_request(asgi_app, 'POST', '/quizzes',
+                                       json_body=quiz_json),
+                    await asgi_request(asgi_app, 'POST', '/quizzes',
+                                       json_body={'previous_questions': []}),
+                    await asgi_request(asgi_app, 'POST', '/questions/search',
+                                       json_body=self.searchTerm))
+            finally:
+                await asgi_app.database.close()
+
+        quiz, invalid_quiz, search = asyncio.run(run())
+
+        self.assertEqual(quiz[0], 200)
+        self.assertEqual(json.loads(quiz[2])['question']['id'],
+                         self.play_quiz_question_id_category_1)
+        self.assertEqual(invalid_quiz[0], 400)
+        self.assertEqual(json.loads(invalid_quiz[2])['message'],
+                         'bad request')
+        self.assertEqual(search[0], 200)
+        self.assertEqual(json.loads(search[2])['total_questions'], 1)
+
+    def test_429_async_mode_play_quiz_rate_limited(self):
+        asgi_app = self.create_asgi_app(
+            RATE_LIMITS={'get_questions_to_play_quiz': (0.01, 1)})
+        limiter = asgi_app.flask_app.extensions['concurrency_limiter']
+
+        async def run():
+            try:
+                return [await asgi_request(
+                    asgi_app, 'POST', '/quizzes',
+                    json_body=self.play_quiz_json_category_1)
+                    for _ in range(2)]
+            finally:
+                await asgi_app.database.close()
+
+        admitted, limited = asyncio.run(run())
+
+        self.assertEqual(admitted[0], 200)
+        self.assertEqual(limited[0], 429)
+        self.assertEqual(json.loads(limited[2])['message'],
+                         'too many requests')
+        self.assertTrue(int(limited[1][b'retry-after']) >= 1)
+        # The admitted request gave its slot back.
+        self.assertTrue(limiter.acquire())
+        limiter.release()
+
+    def make_replica(self):
+        """Copies the test database into a new SQLite read replica"""
+        replica_path = 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'replica.db')
+        replica = create_engine(replica_path)
+        db.metadata.create_all(replica)
+        with self.app.app_context():
+            for table in db.metadata.sorted_tables:
+                rows = [dict(row) for row in
+                        db.session.execute(table.select())]
+                if rows:
+                    replica.execute(table.insert(), rows)
+        replica.execute(Question.__table__.update().where(
+            Question.id == 5).values(answer='Replica'))
+        replica.dispose()
+        return replica_path
+
+    def test_replicas_serve_reads_and_primary_writes(self):
+        app = create_app(self.app_config(
+            DATABASE_REPLICA_URLS=self.make_replica()))
+
+        with app.app_context():
+            self.assertEqual(Question.query.get(5).answer, 'Replica')
+        with app.app_context():
+            db.session().use_primary()
+            self.assertEqual(Question.query.get(5).answer, 'Maya Angelou')
+
+        # The replica doesn't see the new question, but the delete request
+        # reads it from the primary.
+        res = app.test_client().post('/questions', json=self.new_question)
+        created_id = json.loads(res.data)['created_id']
+        with app.app_context():
+            self.assertEqual(Question.query.get(created_id), None)
+
+        res = app.test_client().delete('/questions/' + str(created_id))
+        data = json.loads(res.data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['deleted_id'], created_id)
+
+    def test_replicas_fail_over_to_healthy_replica(self):
+        app = create_app(self.app_config(DATABASE_REPLICA_URLS=','.join([
+            'sqlite:////nonexistent/replica.db', self.make_replica()])))
+
+        for _ in range(3):
+            with app.app_context():
+                self.assertEqual(Question.query.get(5).answer, 'Replica')
+        # The replica that failed is skipped from now on.
+        for _ in range(2):
+            self.assertNotIn('nonexistent', str(
+                app.extensions['replicas'].pick().url))
+
+    def test_replicas_read_your_writes(self):
+        app = create_app(self.app_config(
+            DATABASE_REPLICA_URLS=self.make_replica(), DB_READ_YOUR_WRITES=60))
+
+        res = app.test_client().post('/questions', json=self.new_question)
+        created_id = json.loads(res.data)['created_id']
+        with app.app_context():
+            self.assertEqual(Question.query.get(created_id).answer, 'Berlin')
+
+        app.test_client().delete('/questions/' + str(created_id))
+
+    def get_metric(self, name, labels):
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        prefix = '%s{%s} ' % (name, labels)
+        for line in res.data.decode('utf-8').splitlines():
+            if line.startswith(prefix):
+                return float(line[len(prefix):])
+        return 0
+
+    def test_lazy_startup_does_not_connect_to_the_database(self):
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:////nonexistent/trivia.db',
+            'WARM_UP': 'off'
+        })
+
+        self.assertTrue(app.url_map)
+        with self.assertRaises(ValueError):
+            create_app(self.app_config(WARM_UP='later'))
+
+    def test_background_warm_up_reports_startup_phases(self):
+        app = create_app(self.app_config(WARM_UP='background'))
+        for thread in threading.enumerate():
+            if thread.name == 'warm-up':
+                thread.join()
+
+        self.assertFalse(category_cache.needs_load())
+        self.assertFalse(quiz_index.needs_load())
+        res = app.test_client().get('/categories')
+        self.assertEqual(res.status_code, 200)
+        for phase in ('create_app', 'warm_up', 'first_request'):
+            self.assertTrue(self.get_metric(
+                'trivia_startup_seconds', 'phase="%s"' % phase) > 0)
+
+    def test_200_metrics_count_requests_and_statements(self):
+        labels = 'method="DELETE",route="/questions/<int:question_id>"'
+        requests_before = self.get_metric(
+            'trivia_requests_total', labels + ',status="422"')
+        statements_before = self.get_metric(
+            'trivia_request_sql_statements_sum', labels)
+
+        res = self.client().delete('/questions/1000')
+        self.assertEqual(res.status_code, 422)
+
+        self.assertEqual(self.get_metric(
+            'trivia_requests_total', labels + ',status="422"'),
+            requests_before + 1)
+        self.assertEqual(self.get_metric(
+            'trivia_request_sql_statements_sum', labels),
+            statements_before + 1)
+        self.assertGreater(self.get_metric(
+            'trivia_request_duration_seconds_count', labels), 0)
+
+    def test_failed_statements_leave_no_metrics_state(self):
+        with self.app.app_context():
+            connection = db.engine.connect()
+            self.addCleanup(connection.close)
+            info = dict(connection.info)
+
+            for _ in range(3):
+                with self.assertRaises(exc.DBAPIError):
+                    connection.execute('SELECT * FROM no_such_table')
+            connection.execute('SELECT 1')
+
+            self.assertEqual(dict(connection.info), info)
+
+    def test_200_server_timing_header(self):
+        res = self.client().get('/questions')
+        self.assertNotIn('Server-Timing', res.headers)
+
+        app = create_app(self.app_config(SERVER_TIMING=True))
+        res = app.test_client().get('/questions')
+        server_timing = res.headers['Server-Timing']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(server_timing.startswith('app;dur='))
+        self.assertIn('db;dur=', server_timing)
+        self.assertIn('serialize;dur=', server_timing)
+
+    def test_200_get_stats(self):
+        res = self.client().get('/stats')
+        data = json.loads(res.data)
+        questions = json.loads(self.client().get('/questions').data)
+
+        self.check_200(res, data)
+        self.assertEqual(data['total_questions'],
+                         questions['total_questions'])
+        self.assertEqual(len(data['categories']), 6)
+        self.assertEqual(data['categories']['1']['type'], 'Science')
+        self.assertEqual(data['categories']['1']['total_questions'], 3)
+        self.assertEqual(data['categories']['1']['difficulties'],
+                         {'3': 1, '4': 2})
+        self.assertEqual(sum(data['difficulties'].values()),
+                         data['total_questions'])
+        self.assertEqual(sum(category['total_questions']
+                             for category in data['categories'].values()),
+                         data['total_questions'])
+
+    def test_200_stats_follow_created_and_deleted_questions(self):
+        before = json.loads(self.client().get('/stats').data)
+
+        res = self.client().post('/questions', json=self.new_question)
+        created_id = json.loads(res.data)['created_id']
+        created = json.loads(self.client().get('/stats').data)
+        category = json.loads(self.client().get(
+            '/categories/3/questions').data)
+
+        self.client().delete('/questions/{}'.format(created_id))
+        deleted = json.loads(self.client().get('/stats').data)
+
+        self.assertEqual(created['total_questions'],
+                         before['total_questions'] + 1)
+        self.assertEqual(created['categories']['3']['difficulties']['3'],
+                         before['categories']['3']['difficulties']['3'] + 1)
+        self.assertEqual(category['total_questions'],
+                         created['categories']['3']['total_questions'])
+        self.assertEqual(deleted, before)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":